@@ -68,6 +68,7 @@ CREATE TABLE IF NOT EXISTS media_files (
     id VARCHAR(16) PRIMARY KEY, -- Using custom generated ID
     original_name VARCHAR(255) NOT NULL,
     file_hash VARCHAR(64), -- SHA-256 hash for duplicate detection
+    content_fingerprint VARCHAR(64), -- size:mtime_ns:head/tail hash of images, checked before hashing
     file_type media_type NOT NULL,
     mime_type VARCHAR(100) NOT NULL,
     file_size_bytes BIGINT NOT NULL,
@@ -95,6 +96,7 @@ CREATE INDEX idx_media_favorite ON media_files(favorite);
 CREATE INDEX idx_media_status ON media_files(processing_status);
 CREATE INDEX idx_media_created ON media_files(created_at);
 CREATE INDEX idx_media_file_hash ON media_files(file_hash);
+CREATE INDEX idx_media_content_fingerprint ON media_files(content_fingerprint);
 
 -- Access logs table
 CREATE TABLE IF NOT EXISTS access_logs (
@@ -142,6 +144,15 @@ CREATE TABLE IF NOT EXISTS processing_queue (
 CREATE INDEX idx_queue_status ON processing_queue(status, priority);
 CREATE INDEX idx_queue_worker ON processing_queue(worker_id);
 
+-- Cached ffprobe results, reused on retries while the file is unchanged
+CREATE TABLE IF NOT EXISTS video_metadata (
+    file_path VARCHAR(500) PRIMARY KEY,
+    file_size_bytes BIGINT NOT NULL,
+    file_mtime_ns BIGINT NOT NULL,
+    metadata JSONB NOT NULL,
+    probed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Create update timestamp trigger
 CREATE OR REPLACE FUNCTION update_updated_at_column()
 RETURNS TRIGGER AS $$
@@ -5,8 +5,16 @@ Monitors import directory and processes media files
 """
 
 import os
+import io
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 import subprocess
 import secrets
+import shlex
+import shutil
 import asyncio
 import json
 import hashlib
@@ -17,14 +25,26 @@ from typing import Tuple, Optional
 from datetime import datetime
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+import asyncpg
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from psycopg2 import pool
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
-from PIL import Image
+from PIL import Image, ImageDraw
+import numpy as np
 import pillow_heif
 import yaml
+try:
+    import pyvips
+except (ImportError, OSError):
+    # libvips is optional; Pillow handles all images without it
+    pyvips = None
+try:
+    import xxhash
+except ImportError:
+    # Fingerprints fall back to hashlib's blake2b
+    xxhash = None
 from dotenv import load_dotenv
 
 # Register HEIF/HEIC opener with Pillow
@@ -39,6 +59,329 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# libvips reports every operation at INFO
+logging.getLogger('pyvips').setLevel(logging.WARNING)
+
+# Errors that indicate the database (rather than a single job) is unavailable
+DB_ERRORS = (
+    psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.DatabaseError,
+    asyncpg.PostgresError, asyncpg.InterfaceError, ConnectionError
+)
+UNIQUE_VIOLATIONS = (psycopg2.errors.UniqueViolation, asyncpg.UniqueViolationError)
+
+# Read/write buffer size for streaming file encryption
+ENCRYPT_CHUNK_SIZE = 1 << 20
+
+# Read buffer size for hashlib.file_digest when hashing source files
+HASH_CHUNK_SIZE = 4 << 20
+
+# Bytes read from each end of a file for its content fingerprint
+FINGERPRINT_SAMPLE_SIZE = 64 << 10
+
+# MIME types by lowercase file extension
+MIME_TYPES = {
+    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
+    '.gif': 'image/gif', '.webp': 'image/webp', '.heic': 'image/heic','.dng': 'image/dng',
+    '.mp4': 'video/mp4', '.avi': 'video/avi', '.mov': 'video/quicktime',
+    '.mkv': 'video/x-matroska', '.webm': 'video/webm'
+}
+
+# Keep FFmpeg's stderr for real errors only; callers that want progress add -progress
+FFMPEG_QUIET_ARGS = ['-hide_banner', '-nostats', '-loglevel', 'error']
+
+
+def _flatten_rgba(img: Image.Image) -> Image.Image:
+    """Composite an RGBA/LA image onto a white background as RGB"""
+    if img.mode == 'LA':
+        img = img.convert('RGBA')
+    arr = np.asarray(img, dtype=np.uint8)
+    alpha = arr[..., 3:4].astype(np.float32) * (1 / 255)
+    out = arr[..., :3].astype(np.float32) * alpha + 255.0 * (1 - alpha) + 0.5
+    return Image.fromarray(out.astype(np.uint8), 'RGB')
+
+
+async def _run_process(cmd: list) -> Tuple[int, bytes, bytes]:
+    """Run a command without blocking the event loop, returning (returncode, stdout, stderr)"""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    return proc.returncode, stdout, stderr
+
+
+def _file_size(path: Path) -> int:
+    """Size of a file from a single stat, or 0 if it does not exist"""
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def _content_fingerprint(file_path: Path, file_stats: os.stat_result) -> str:
+    """Cheap fingerprint of a file from its size, mtime and first/last bytes"""
+    size = file_stats.st_size
+    with open(file_path, 'rb') as f:
+        sample = f.read(FINGERPRINT_SAMPLE_SIZE)
+        if size > FINGERPRINT_SAMPLE_SIZE:
+            f.seek(max(FINGERPRINT_SAMPLE_SIZE, size - FINGERPRINT_SAMPLE_SIZE))
+            sample += f.read(FINGERPRINT_SAMPLE_SIZE)
+    if xxhash:
+        digest = xxhash.xxh3_64_hexdigest(sample)
+    else:
+        digest = hashlib.blake2b(sample, digest_size=8).hexdigest()
+    return f"{size}:{file_stats.st_mtime_ns}:{digest}"
+
+
+def _write_all(fd: int, data) -> None:
+    """Write a whole buffer to a raw file descriptor"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _encrypt_file(file_path: Path, key: bytes) -> Path:
+    """Encrypt file with AES-128-CBC, streaming IV + ciphertext to disk"""
+    encrypted_path = file_path.with_suffix(file_path.suffix + '.enc')
+    
+    # Check if file exists and has content
+    if not file_path.exists():
+        logger.error(f"File to encrypt does not exist: {file_path}")
+        return _write_placeholder_file(encrypted_path, key)
+    
+    file_size = file_path.stat().st_size
+    if file_size == 0:
+        logger.error(f"File to encrypt is empty: {file_path}")
+        # Handle same as non-existent file
+        file_path.unlink()  # Remove empty file
+        return _write_placeholder_file(encrypted_path, key)
+    
+    if file_size < 100:
+        logger.warning(f"File to encrypt is suspiciously small ({file_size} bytes): {file_path}")
+    
+    iv = os.urandom(16)
+    
+    try:
+        logger.info(f"Encrypting file: {file_path} ({file_size} bytes)")
+    
+        cipher = Cipher(
+            algorithms.AES(key),
+            modes.CBC(iv),
+            backend=default_backend()
+        )
+        encryptor = cipher.encryptor()
+    
+        # Reusable buffers, no larger than the file for small thumbnails;
+        # update_into needs block_size - 1 bytes of headroom
+        chunk_size = min(ENCRYPT_CHUNK_SIZE, (file_size // 16 + 1) * 16)
+        buf = bytearray(chunk_size)
+        out = bytearray(chunk_size + 15)
+        buf_mv = memoryview(buf)
+        out_mv = memoryview(out)
+        pending = 0  # Unencrypted bytes carried over at the start of buf
+    
+        fd = os.open(encrypted_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # Reserve the final size up front: IV + input padded to the next block
+            try:
+                os.posix_fallocate(fd, 0, 16 + (file_size // 16 + 1) * 16)
+            except (AttributeError, OSError):
+                pass
+            
+            # Write encrypted file (IV + ciphertext)
+            _write_all(fd, iv)
+            
+            with open(file_path, 'rb', buffering=0) as fin:
+                while True:
+                    n = fin.readinto(buf_mv[pending:])
+                    if not n:
+                        break
+                    pending += n
+                    
+                    # Encrypt whole blocks only, keep the sub-block tail for next read
+                    aligned = pending - (pending % 16)
+                    if aligned:
+                        written = encryptor.update_into(buf_mv[:aligned], out_mv)
+                        _write_all(fd, out_mv[:written])
+                        tail = pending - aligned
+                        buf_mv[:tail] = buf_mv[aligned:pending]
+                        pending = tail
+            
+            # PKCS7 pad the final partial block
+            pad_len = 16 - pending
+            buf_mv[pending:16] = bytes([pad_len]) * pad_len
+            written = encryptor.update_into(buf_mv[:16], out_mv)
+            _write_all(fd, out_mv[:written])
+            _write_all(fd, encryptor.finalize())
+        finally:
+            os.close(fd)
+    
+        encrypted_size = encrypted_path.stat().st_size
+        logger.info(f"Encrypted file created: {encrypted_path} ({encrypted_size} bytes)")
+    
+        # Validate encrypted file
+        if encrypted_size < 32:  # Minimum size: 16 bytes IV + 16 bytes data
+            logger.error(f"Encrypted file too small: {encrypted_size} bytes")
+    
+        # Remove original only if encryption was successful
+        file_path.unlink()
+    
+    except Exception as e:
+        logger.error(f"Encryption failed for {file_path}: {e}")
+        # Create placeholder if encryption fails
+        if encrypted_path.exists():
+            encrypted_path.unlink()
+        return _write_placeholder_file(encrypted_path, key)
+    
+    return encrypted_path
+
+def _write_placeholder_file(encrypted_path: Path, key: bytes) -> Path:
+    """Write a minimal placeholder encrypted file"""
+    # This is a 1x1 black WebP encrypted with zeros IV
+    placeholder_webp = b'RIFF$\x00\x00\x00WEBPVP8 \x18\x00\x00\x000\x01\x00\x9d\x01*\x01\x00\x01\x00\x01@%\xa4\x00\x03p\x00\xfe\xfb\x94\x00\x00'
+    iv = b'\x00' * 16
+    
+    # Pad and encrypt placeholder
+    pad_len = 16 - (len(placeholder_webp) % 16)
+    padded = placeholder_webp + bytes([pad_len]) * pad_len
+    
+    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+    encryptor = cipher.encryptor()
+    ciphertext = encryptor.update(padded) + encryptor.finalize()
+    
+    with open(encrypted_path, 'wb') as f:
+        f.write(iv + ciphertext)
+    
+    logger.warning(f"Created placeholder encrypted file: {encrypted_path}")
+    return encrypted_path
+
+
+def _generate_image_thumbnail(img: Image.Image, output, thumbnail_config: dict):
+    """Generate thumbnail from a decoded RGB image"""
+    # Create thumbnail with fixed width
+    thumbnail_width = thumbnail_config['width']
+    
+    # Calculate proportional height
+    aspect_ratio = img.height / img.width
+    thumbnail_height = int(thumbnail_width * aspect_ratio)
+    
+    # Resize for thumbnail
+    img_thumb = img.resize((thumbnail_width, thumbnail_height), Image.Resampling.LANCZOS)
+    
+    # Save thumbnail as WebP
+    img_thumb.save(
+        output, 'WEBP',
+        quality=thumbnail_config['quality'],
+        method=thumbnail_config['method']
+    )
+
+
+def _encrypt_bytes(plaintext: bytes, key: bytes) -> bytearray:
+    """Encrypt an in-memory payload as IV + AES-128-CBC ciphertext"""
+    iv = os.urandom(16)
+    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+    encryptor = cipher.encryptor()
+    
+    # Encrypt straight into one preallocated IV + ciphertext buffer instead of
+    # concatenating copies; update_into needs block_size - 1 bytes of headroom
+    aligned = len(plaintext) - (len(plaintext) % 16)
+    out = bytearray(16 + aligned + 16 + 15)
+    out_mv = memoryview(out)
+    out_mv[:16] = iv
+    written = 16 + encryptor.update_into(memoryview(plaintext)[:aligned], out_mv[16:])
+    
+    # PKCS7 pad the final partial block
+    pad_len = 16 - (len(plaintext) - aligned)
+    last_block = bytes(plaintext[aligned:]) + bytes([pad_len]) * pad_len
+    written += encryptor.update_into(last_block, out_mv[written:])
+    encryptor.finalize()
+    out_mv.release()
+    del out[written:]
+    return out
+
+
+def _encode_image_vips(input_path: str, media_config: dict) -> Tuple[bytes, bytes, int, int]:
+    """Resize and WebP-encode an image and its thumbnail with libvips"""
+    image_config = media_config['image']
+    thumbnail_config = media_config['thumbnail']
+    
+    # Shrink-on-load thumbnail; only ever downscales to fit the max box
+    img = pyvips.Image.thumbnail(
+        input_path, image_config['max_width'],
+        height=image_config['max_height'], size='down'
+    )
+    if img.interpretation != 'srgb':
+        img = img.colourspace('srgb')
+    if img.hasalpha():
+        img = img.flatten(background=[255, 255, 255])
+    # The source is read sequentially, so render the downscaled image once
+    # before it feeds both outputs
+    img = img.copy_memory()
+        
+    image_bytes = img.webpsave_buffer(Q=image_config['quality'], effort=image_config['method'])
+    
+    # Thumbnail with fixed width from the already downscaled image
+    thumbnail = img.resize(thumbnail_config['width'] / img.width)
+    thumbnail_bytes = thumbnail.webpsave_buffer(
+        Q=thumbnail_config['quality'], effort=thumbnail_config['method']
+    )
+    
+    return image_bytes, thumbnail_bytes, img.width, img.height
+
+
+def _process_image_worker(input_path: str, key: bytes, media_config: dict) -> dict:
+    """Decode, resize, WebP-encode and encrypt an image and its thumbnail.
+    
+    Runs in a worker process, so it only takes and returns picklable values;
+    nothing is written to disk here. libvips is used when available, with
+    Pillow as the fallback for formats it cannot read.
+    """
+    if pyvips:
+        try:
+            image_bytes, thumbnail_bytes, width, height = _encode_image_vips(input_path, media_config)
+            return {
+                'width': width,
+                'height': height,
+                'image': _encrypt_bytes(image_bytes, key),
+                'thumbnail': _encrypt_bytes(thumbnail_bytes, key)
+            }
+        except pyvips.Error as e:
+            logger.warning(f"libvips could not process {input_path}, falling back to Pillow: {e}")
+            
+    image_config = media_config['image']
+    
+    with Image.open(input_path) as img:
+        # Convert to RGB if necessary
+        if img.mode in ('RGBA', 'LA'):
+            img = _flatten_rgba(img)
+        elif img.mode not in ('RGB',):
+            img = img.convert('RGB')
+            
+        # Resize if needed for main image
+        max_width = image_config['max_width']
+        max_height = image_config['max_height']
+        
+        if img.width > max_width or img.height > max_height:
+            img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+            
+        # Encode as WebP
+        image_buf = io.BytesIO()
+        img.save(image_buf, 'WEBP', quality=image_config['quality'], method=image_config['method'])
+        
+        width, height = img.size
+        
+        # Generate thumbnail from the already decoded and downscaled image
+        thumbnail_buf = io.BytesIO()
+        _generate_image_thumbnail(img, thumbnail_buf, media_config['thumbnail'])
+        
+    return {
+        'width': width,
+        'height': height,
+        'image': _encrypt_bytes(image_buf.getvalue(), key),
+        'thumbnail': _encrypt_bytes(thumbnail_buf.getvalue(), key)
+    }
+
 
 
 class Config:
@@ -66,6 +409,7 @@ class Config:
                 'extensions': ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.dng'],
                 'output_format': 'webp',
                 'quality': 85,
+                'method': 6,  # WebP encoder effort (0 = fastest, 6 = smallest)
                 'max_width': 3840,
                 'max_height': 2160
             },
@@ -75,6 +419,9 @@ class Config:
                 'segment_duration': 10,
                 'preset': 'veryfast',
                 'crf': 23,
+                'hardware_encoding': os.getenv('VIDEO_HW_ENCODING', 'true').lower() == 'true',
+                'hardware_decoding': os.getenv('VIDEO_HW_DECODING', 'false').lower() == 'true',
+                'vaapi_device': '/dev/dri/renderD128',
                 'audio_bitrate': '128k'
             },
             'thumbnail': {
@@ -82,7 +429,7 @@ class Config:
                 'fps': 10,
                 'duration': 3,
                 'quality': 75,
-                'compression_level': 6,
+                'method': 4,  # WebP encoder effort, also passed to FFmpeg as -compression_level
                 'start_position': '10%'
             },
             'preview': {
@@ -90,20 +437,50 @@ class Config:
                 'fps': 5,
                 'max_frames': 20,
                 'quality': 80,
-                'compression_level': 6,
+                'method': 1,  # WebP encoder effort; previews favour encode speed
                 'scene_threshold': 0.4
             }
         }
         
+        # Lowercase extension sets for O(1) file type checks
+        self.image_extensions = frozenset(ext.lower() for ext in self.media['image']['extensions'])
+        self.video_extensions = frozenset(ext.lower() for ext in self.media['video']['extensions'])
+        
+        # Jobs processed at once, and how many of them may run FFmpeg at the
+        # same time; each FFmpeg run gets an equal share of the cores
+        cpu_count = os.cpu_count() or 1
+        worker_concurrency = int(os.getenv('WORKER_CONCURRENCY', max(1, cpu_count // 4)))
+        ffmpeg_concurrency = min(
+            worker_concurrency,
+            int(os.getenv('FFMPEG_CONCURRENCY', max(1, worker_concurrency // 2)))
+        )
+        self.processing = {
+            'worker_concurrency': worker_concurrency,
+            'ffmpeg_concurrency': ffmpeg_concurrency,
+            'ffmpeg_threads': max(1, cpu_count // ffmpeg_concurrency),
+            # One connection per concurrent job plus the scanner, watcher,
+            # health monitor and key refresh
+            'db_pool_size': worker_concurrency + 4
+        }
+        
         # Create directories if they don't exist
         for path in self.storage.values():
             path.mkdir(parents=True, exist_ok=True)
+            
+    def get_file_type(self, ext: str) -> Optional[str]:
+        """Return 'image' or 'video' for a lowercase extension, or None if unsupported"""
+        if ext in self.image_extensions:
+            return 'image'
+        if ext in self.video_extensions:
+            return 'video'
+        return None
 
 
 class DatabaseManager:
     """Database operations manager with connection pooling and auto-reconnection"""
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, pool_size: int = 10):
         self.config = config
+        self.pool_size = pool_size
         self.connection_pool = None
         self.max_retries = 3
         self.retry_delay = 2  # seconds
@@ -112,8 +489,8 @@ class DatabaseManager:
         """Establish database connection pool"""
         try:
             self.connection_pool = psycopg2.pool.ThreadedConnectionPool(
-                minconn=1,
-                maxconn=10,
+                minconn=2,
+                maxconn=self.pool_size,
                 **self.config
             )
             logger.info("Connected to database with connection pool")
@@ -135,13 +512,7 @@ class DatabaseManager:
                     logger.warning("Connection pool not initialized, reconnecting...")
                     self.connect()
                 
-                conn = self.connection_pool.getconn()
-                
-                # Test connection health
-                with conn.cursor() as test_cursor:
-                    test_cursor.execute("SELECT 1")
-                
-                return conn
+                return self.connection_pool.getconn()
                 
             except (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.DatabaseError) as e:
                 logger.warning(f"Database connection attempt {attempt + 1} failed: {e}")
@@ -167,60 +538,73 @@ class DatabaseManager:
         
         raise psycopg2.OperationalError("Could not establish database connection after retries")
     
-    def _put_connection(self, conn):
-        """Return connection to pool"""
+    def _put_connection(self, conn, close: bool = False):
+        """Return connection to pool, optionally discarding it"""
         if self.connection_pool and conn:
             try:
-                self.connection_pool.putconn(conn)
+                self.connection_pool.putconn(conn, close=close)
             except Exception as e:
                 logger.warning(f"Error returning connection to pool: {e}")
                 
-    def execute(self, query: str, params: tuple = None):
-        """Execute a query with automatic retry"""
-        conn = None
-        try:
+    def _run(self, operation, commit: bool = False):
+        """Run operation(cursor) on a pooled connection.
+        
+        Pooled connections are not probed before use; if the statement fails
+        with a connection-level error the connection is discarded and the
+        operation is retried once on a fresh one.
+        """
+        for attempt in range(2):
             conn = self._get_connection()
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, params)
-                conn.commit()
-        except Exception as e:
-            if conn:
+            try:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    result = operation(cursor)
+                if commit:
+                    conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                self._put_connection(conn, close=True)
+                if attempt == 0:
+                    logger.warning(f"Discarding stale database connection and retrying: {e}")
+                    continue
+                raise
+            except Exception:
                 try:
                     conn.rollback()
                 except:
                     pass
+                self._put_connection(conn)
+                raise
+            self._put_connection(conn)
+            return result
+                
+    def execute(self, query: str, params: tuple = None):
+        """Execute a query with automatic retry"""
+        try:
+            self._run(lambda cursor: cursor.execute(query, params), commit=True)
+        except Exception as e:
             logger.error(f"Database execute error: {e}")
             raise
-        finally:
-            self._put_connection(conn)
             
     def fetch_one(self, query: str, params: tuple = None) -> dict:
         """Fetch one record with automatic retry"""
-        conn = None
+        def operation(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchone()
         try:
-            conn = self._get_connection()
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, params)
-                return cursor.fetchone()
+            return self._run(operation)
         except Exception as e:
             logger.error(f"Database fetch_one error: {e}")
             raise
-        finally:
-            self._put_connection(conn)
             
     def fetch_all(self, query: str, params: tuple = None) -> list:
         """Fetch all records with automatic retry"""
-        conn = None
+        def operation(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchall()
         try:
-            conn = self._get_connection()
-            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, params)
-                return cursor.fetchall()
+            return self._run(operation)
         except Exception as e:
             logger.error(f"Database fetch_all error: {e}")
             raise
-        finally:
-            self._put_connection(conn)
     
     def check_connection_health(self) -> bool:
         """Check if database connection pool is healthy"""
@@ -256,6 +640,29 @@ class DatabaseManager:
             logger.warning(f"Error getting connection stats: {e}")
             return {"status": "error", "error": str(e)}
             
+    # schema.sql only runs when the database is first created, so columns
+    # added since then are applied here; every statement must be idempotent
+    MIGRATIONS = [
+        "ALTER TABLE media_files ADD COLUMN IF NOT EXISTS content_fingerprint VARCHAR(64)",
+        "CREATE INDEX IF NOT EXISTS idx_media_content_fingerprint ON media_files(content_fingerprint)",
+        """
+        CREATE TABLE IF NOT EXISTS video_metadata (
+            file_path VARCHAR(500) PRIMARY KEY,
+            file_size_bytes BIGINT NOT NULL,
+            file_mtime_ns BIGINT NOT NULL,
+            metadata JSONB NOT NULL,
+            probed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]
+    
+    def apply_migrations(self):
+        """Bring an existing database up to the current schema"""
+        def migrate(cursor):
+            for statement in self.MIGRATIONS:
+                cursor.execute(statement)
+        self._run(migrate, commit=True)
+        
     def get_or_create_encryption_key(self) -> dict:
         """Get active encryption key or create new one"""
         query = """
@@ -305,27 +712,37 @@ class DatabaseManager:
                     raise Exception("Unable to create or retrieve encryption key")
             finally:
                 self._put_connection(conn)
-        
-        # Ensure the encryption key file contains binary data (FFmpeg requirement)
-        self._write_binary_key_file(key['key_value'])
             
         return key
-    
-    def _write_binary_key_file(self, key_hex: str):
-        """Write binary key file for FFmpeg (expects 16 bytes, not hex string)"""
-        key_path = Path('/app/private/encryption.key')
-        key_bytes = bytes.fromhex(key_hex)
-        with open(key_path, 'wb') as f:
-            f.write(key_bytes)
         
-    def add_to_processing_queue(self, file_path: str, file_type: str):
-        """Add file to processing queue"""
+    def add_to_processing_queue_batch(self, rows: list) -> int:
+        """Add many (file_path, file_type) rows to the processing queue, returning how many were new"""
+        if not rows:
+            return 0
         query = """
             INSERT INTO processing_queue (file_path, file_type, status)
-            VALUES (%s, %s, 'queued')
+            VALUES %s
             ON CONFLICT (file_path) DO NOTHING
+            RETURNING 1
         """
-        self.execute(query, (file_path, file_type))
+        # fetch=True collects the RETURNING rows of every page, unlike rowcount
+        inserted = self._run(
+            lambda cursor: execute_values(
+                cursor, query, rows, template="(%s, %s, 'queued')", page_size=500, fetch=True
+            ),
+            commit=True
+        )
+        return len(inserted)
+        
+    def get_queued_paths(self, file_paths: list) -> set:
+        """Return which of the given paths already have a processing queue entry"""
+        if not file_paths:
+            return set()
+        rows = self.fetch_all(
+            "SELECT file_path FROM processing_queue WHERE file_path = ANY(%s)",
+            (file_paths,)
+        )
+        return {row['file_path'] for row in rows}
         
     def update_queue_status(self, file_path: str, status: str, error_message: str = None):
         """Update processing queue status"""
@@ -347,87 +764,496 @@ class DatabaseManager:
             LIMIT 1
         """
         return self.fetch_one(query, (file_hash,))
-    
-    def save_media_metadata(self, metadata: dict):
-        """Save media file metadata"""
+        
+    def check_duplicate_by_fingerprint(self, fingerprint: str) -> Optional[dict]:
+        """Check if a file with this content fingerprint already exists"""
         query = """
-            INSERT INTO media_files (
-                id, original_name, file_hash, file_type, mime_type, file_size_bytes,
-                width, height, duration_seconds, storage_path, 
-                thumbnail_path, preview_path, encryption_key_id,
-                processing_status, processing_completed_at, metadata
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), %s
-            )
+            SELECT id, original_name, file_type, storage_path, file_hash
+            FROM media_files
+            WHERE content_fingerprint = %s
+            LIMIT 1
         """
-        self.execute(query, (
+        return self.fetch_one(query, (fingerprint,))
+    
+    MEDIA_FILE_COLUMNS = """
+        id, original_name, file_hash, file_type, mime_type, file_size_bytes,
+        width, height, duration_seconds, storage_path,
+        thumbnail_path, preview_path, encryption_key_id,
+        processing_status, processing_completed_at, metadata, content_fingerprint
+    """
+    MEDIA_FILE_TEMPLATE = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW(), %s, %s)"
+    
+    def _media_row(self, metadata: dict) -> tuple:
+        """Build the media_files column values for a metadata dict"""
+        return (
             metadata['id'], metadata['original_name'], metadata['file_hash'],
             metadata['file_type'], metadata['mime_type'], metadata['file_size_bytes'],
             metadata.get('width'), metadata.get('height'), metadata.get('duration_seconds'),
             metadata['storage_path'], metadata.get('thumbnail_path'),
             metadata.get('preview_path'), metadata['encryption_key_id'],
-            'completed', json.dumps(metadata.get('extra_metadata', {}))
-        ))
+            'completed', json.dumps(metadata.get('extra_metadata', {})),
+            metadata.get('content_fingerprint')
+        )
+    
+    def complete_media_file(self, file_path: str, metadata: dict):
+        """Save media metadata and mark its queue entry completed in one statement"""
+        query = f"""
+            WITH ins AS (
+                INSERT INTO media_files ({self.MEDIA_FILE_COLUMNS})
+                VALUES {self.MEDIA_FILE_TEMPLATE}
+                RETURNING id
+            )
+            UPDATE processing_queue
+            SET status = 'completed', error_message = NULL, completed_at = NOW()
+            WHERE file_path = %s AND EXISTS (SELECT 1 FROM ins)
+        """
+        self.execute(query, self._media_row(metadata) + (file_path,))
         
-    def get_pending_jobs(self, limit: int = 5) -> list:
-        """Get pending jobs from the queue"""
+    def get_video_metadata(self, file_path: str, size: int, mtime_ns: int) -> Optional[dict]:
+        """Get cached probe results for an unchanged video file"""
         query = """
-            SELECT id, file_path, file_type, retry_count, max_retries
-            FROM processing_queue
-            WHERE status = 'queued'
-            AND retry_count < max_retries
-            ORDER BY priority DESC, queued_at ASC
-            LIMIT %s
+            SELECT metadata
+            FROM video_metadata
+            WHERE file_path = %s AND file_size_bytes = %s AND file_mtime_ns = %s
         """
-        return self.fetch_all(query, (limit,))
+        row = self.fetch_one(query, (file_path, size, mtime_ns))
+        return row['metadata'] if row else None
         
-    def get_failed_jobs_for_retry(self, limit: int = 5) -> list:
-        """Get failed jobs that can be retried"""
+    def save_video_metadata(self, file_path: str, size: int, mtime_ns: int, metadata: dict):
+        """Cache probe results for a video file"""
         query = """
-            SELECT id, file_path, file_type, retry_count, max_retries
+            INSERT INTO video_metadata (file_path, file_size_bytes, file_mtime_ns, metadata)
+            VALUES (%s, %s, %s, %s::jsonb)
+            ON CONFLICT (file_path) DO UPDATE
+            SET file_size_bytes = EXCLUDED.file_size_bytes,
+                file_mtime_ns = EXCLUDED.file_mtime_ns,
+                metadata = EXCLUDED.metadata,
+                probed_at = NOW()
+        """
+        self.execute(query, (file_path, size, mtime_ns, json.dumps(metadata)))
+        
+    def delete_video_metadata(self, file_path: str):
+        """Drop cached probe results for a video file"""
+        self.execute("DELETE FROM video_metadata WHERE file_path = %s", (file_path,))
+        
+    CLAIM_QUERY = """
+        WITH next_jobs AS (
+            SELECT id
             FROM processing_queue
-            WHERE status = 'failed'
+            WHERE {condition}
             AND retry_count < max_retries
-            AND (completed_at IS NULL OR completed_at < NOW() - INTERVAL '5 minutes')
             ORDER BY priority DESC, queued_at ASC
-            LIMIT %s
+            LIMIT {limit}
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE processing_queue q
+        SET status = 'processing',
+            started_at = NOW(),
+            retry_count = q.retry_count + CASE WHEN q.status = 'failed' THEN 1 ELSE 0 END
+        FROM next_jobs
+        WHERE q.id = next_jobs.id
+        RETURNING q.id, q.file_path, q.file_type, q.retry_count, q.max_retries
+    """
+    CLAIM_CONDITIONS = {
+        False: "status = 'queued'",
+        True: "status = 'failed' AND (completed_at IS NULL OR completed_at < NOW() - INTERVAL '5 minutes')"
+    }
+    
+    def requeue_interrupted_jobs(self) -> int:
+        """Return jobs left in 'processing' by a previous run to the queue"""
+        query = """
+            UPDATE processing_queue
+            SET status = 'queued', started_at = NULL
+            WHERE status = 'processing'
+        """
+        
+        def requeue(cursor):
+            cursor.execute(query)
+            return cursor.rowcount
+        return self._run(requeue, commit=True)
+        
+    def claim_jobs(self, limit: int = 5, retry_failed: bool = False) -> list:
+        """Mark up to limit queued (or retryable failed) jobs as processing and return them.
+        
+        Rows locked by another worker are skipped, so concurrent workers never
+        claim the same job. Claiming a failed job counts as a retry.
         """
-        return self.fetch_all(query, (limit,))
+        query = self.CLAIM_QUERY.format(condition=self.CLAIM_CONDITIONS[retry_failed], limit='%s')
         
-    def increment_retry_count(self, queue_id: str):
-        """Increment retry count for a job"""
+        def claim(cursor):
+            cursor.execute(query, (limit,))
+            return cursor.fetchall()
+        return self._run(claim, commit=True)
+
+
+class AsyncDatabaseManager:
+    """Async database access for the hot processing-path queries.
+    
+    Uses an asyncpg pool by default. With DB_DRIVER=psycopg2 every call is
+    delegated to the synchronous DatabaseManager instead.
+    """
+    MEDIA_FILE_TEMPLATE = "($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, NOW(), $15, $16)"
+    
+    def __init__(self, config: dict, sync_db: DatabaseManager, pool_size: int = 10):
+        self.config = config
+        self.sync_db = sync_db
+        self.pool_size = pool_size
+        self.driver = os.getenv('DB_DRIVER', 'asyncpg').lower()
+        self.pool = None
+        
+    async def connect(self):
+        """Create the asyncpg connection pool"""
+        if self.driver != 'asyncpg':
+            logger.info(f"Using {self.driver} driver for processing queries")
+            return
+        try:
+            self.pool = await asyncpg.create_pool(
+                host=self.config['host'],
+                port=int(self.config['port']),
+                database=self.config['database'],
+                user=self.config['user'],
+                password=self.config['password'],
+                min_size=2,
+                max_size=self.pool_size
+            )
+            logger.info("Connected to database with asyncpg pool")
+        except Exception as e:
+            logger.error(f"asyncpg pool creation failed: {e}")
+            raise
+            
+    async def disconnect(self):
+        """Close the asyncpg connection pool"""
+        if self.pool:
+            await self.pool.close()
+            logger.info("asyncpg connection pool closed")
+            
+    async def add_to_processing_queue_batch(self, rows: list) -> int:
+        """Add many (file_path, file_type) rows to the processing queue in one statement, returning how many were new"""
+        if not self.pool:
+            return self.sync_db.add_to_processing_queue_batch(rows)
+        if not rows:
+            return 0
+        query = """
+            INSERT INTO processing_queue (file_path, file_type, status)
+            SELECT file_path, file_type, 'queued'
+            FROM unnest($1::varchar[], $2::varchar[]) AS t(file_path, file_type)
+            ON CONFLICT (file_path) DO NOTHING
+        """
+        file_paths, file_types = zip(*rows)
+        async with self.pool.acquire() as con:
+            status = await con.execute(query, list(file_paths), list(file_types))
+        # Command tag is 'INSERT 0 <rows inserted>'
+        return int(status.split()[-1])
+            
+    async def update_queue_status(self, file_path: str, status: str, error_message: str = None):
+        """Update processing queue status"""
+        if not self.pool:
+            return self.sync_db.update_queue_status(file_path, status, error_message)
         query = """
             UPDATE processing_queue
-            SET retry_count = retry_count + 1,
-                status = 'queued',
-                error_message = NULL,
-                started_at = NULL,
-                completed_at = NULL
-            WHERE id = %s
+            SET status = $1, error_message = $2,
+                started_at = CASE WHEN $1 = 'processing' THEN NOW() ELSE started_at END,
+                completed_at = CASE WHEN $1 IN ('completed', 'failed') THEN NOW() ELSE completed_at END
+            WHERE file_path = $3
         """
-        self.execute(query, (queue_id,))
-        
-    def mark_job_as_processing(self, queue_id: str):
-        """Mark a job as processing"""
+        async with self.pool.acquire() as con:
+            await con.execute(query, status, error_message, file_path)
+            
+    async def check_duplicate_by_hash(self, file_hash: str) -> Optional[dict]:
+        """Check if a file with this hash already exists"""
+        if not self.pool:
+            return self.sync_db.check_duplicate_by_hash(file_hash)
+        query = """
+            SELECT id, original_name, file_type, storage_path
+            FROM media_files
+            WHERE file_hash = $1
+            LIMIT 1
+        """
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow(query, file_hash)
+        return dict(row) if row else None
+        
+    async def check_duplicate_by_fingerprint(self, fingerprint: str) -> Optional[dict]:
+        """Check if a file with this content fingerprint already exists"""
+        if not self.pool:
+            return self.sync_db.check_duplicate_by_fingerprint(fingerprint)
         query = """
+            SELECT id, original_name, file_type, storage_path, file_hash
+            FROM media_files
+            WHERE content_fingerprint = $1
+            LIMIT 1
+        """
+        async with self.pool.acquire() as con:
+            row = await con.fetchrow(query, fingerprint)
+        return dict(row) if row else None
+    
+    async def complete_media_file(self, file_path: str, metadata: dict):
+        """Save media metadata and mark its queue entry completed in one statement"""
+        if not self.pool:
+            return self.sync_db.complete_media_file(file_path, metadata)
+        query = f"""
+            WITH ins AS (
+                INSERT INTO media_files ({DatabaseManager.MEDIA_FILE_COLUMNS})
+                VALUES {self.MEDIA_FILE_TEMPLATE}
+                RETURNING id
+            )
             UPDATE processing_queue
-            SET status = 'processing',
-                started_at = NOW()
-            WHERE id = %s
+            SET status = 'completed', error_message = NULL, completed_at = NOW()
+            WHERE file_path = $17 AND EXISTS (SELECT 1 FROM ins)
+        """
+        async with self.pool.acquire() as con:
+            await con.execute(query, *self.sync_db._media_row(metadata), file_path)
+            
+    async def get_video_metadata(self, file_path: str, size: int, mtime_ns: int) -> Optional[dict]:
+        """Get cached probe results for an unchanged video file"""
+        if not self.pool:
+            return self.sync_db.get_video_metadata(file_path, size, mtime_ns)
+        query = """
+            SELECT metadata
+            FROM video_metadata
+            WHERE file_path = $1 AND file_size_bytes = $2 AND file_mtime_ns = $3
         """
-        self.execute(query, (queue_id,))
+        async with self.pool.acquire() as con:
+            metadata = await con.fetchval(query, file_path, size, mtime_ns)
+        return json.loads(metadata) if metadata else None
+        
+    async def save_video_metadata(self, file_path: str, size: int, mtime_ns: int, metadata: dict):
+        """Cache probe results for a video file"""
+        if not self.pool:
+            return self.sync_db.save_video_metadata(file_path, size, mtime_ns, metadata)
+        query = """
+            INSERT INTO video_metadata (file_path, file_size_bytes, file_mtime_ns, metadata)
+            VALUES ($1, $2, $3, $4::jsonb)
+            ON CONFLICT (file_path) DO UPDATE
+            SET file_size_bytes = EXCLUDED.file_size_bytes,
+                file_mtime_ns = EXCLUDED.file_mtime_ns,
+                metadata = EXCLUDED.metadata,
+                probed_at = NOW()
+        """
+        async with self.pool.acquire() as con:
+            await con.execute(query, file_path, size, mtime_ns, json.dumps(metadata))
+            
+    async def delete_video_metadata(self, file_path: str):
+        """Drop cached probe results for a video file"""
+        if not self.pool:
+            return self.sync_db.delete_video_metadata(file_path)
+        async with self.pool.acquire() as con:
+            await con.execute("DELETE FROM video_metadata WHERE file_path = $1", file_path)
+            
+    async def claim_jobs(self, limit: int = 5, retry_failed: bool = False) -> list:
+        """Mark up to limit queued (or retryable failed) jobs as processing and return them"""
+        if not self.pool:
+            return self.sync_db.claim_jobs(limit, retry_failed)
+        query = DatabaseManager.CLAIM_QUERY.format(
+            condition=DatabaseManager.CLAIM_CONDITIONS[retry_failed], limit='$1'
+        )
+        async with self.pool.acquire() as con:
+            return [dict(row) for row in await con.fetch(query, limit)]
 
 
 class MediaProcessor:
     """Media processing engine"""
-    def __init__(self, config: Config, db: DatabaseManager):
+    def __init__(self, config: Config, db: DatabaseManager, async_db: AsyncDatabaseManager):
         self.config = config
         self.db = db
+        self.async_db = async_db
         self.encryption_key_path = config.storage['private'] / 'encryption.key'
         # Ensure encryption key is in binary format on startup
         logger.info("Initializing encryption key...")
-        self.encryption_key = self.db.get_or_create_encryption_key()
+        self.set_encryption_key(self.db.get_or_create_encryption_key())
         logger.info(f"Encryption key initialized with ID: {self.encryption_key['id']}")
+        # Worker processes for CPU-bound image encoding and file encryption
+        self._pool = self._create_pool()
+        # FFmpeg runs have their own budget below the job count, so video jobs
+        # queue for the encoder while image jobs keep running
+        self._ffmpeg_slots = asyncio.BoundedSemaphore(config.processing['ffmpeg_concurrency'])
+        # Rendered once; written out whenever a static thumbnail cannot be made
+        self._placeholder_bytes = self._render_placeholder_thumbnail()
+        # Probe once for a usable hardware H.264 encoder
+        self.video_encoder = self.detect_video_encoder()
+        logger.info(f"Using video encoder: {self.video_encoder['name']}")
+        # Input options for GPU decoding, empty when decoding in software
+        self.hwaccel_args = self.detect_hwaccel()
+        logger.info(f"Using video decoder: {self.hwaccel_args[1] if self.hwaccel_args else 'software'}")
+        
+    def set_encryption_key(self, key: dict):
+        """Cache the active key and its decoded bytes"""
+        self.encryption_key = key
+        self._key_bytes = bytes.fromhex(key['key_value'])
+        self._key_id = key['id']
+        self.ensure_key_file_written()
+        
+    def ensure_key_file_written(self):
+        """Write the active key to the key file served to HLS players"""
+        self._write_key_file(self.encryption_key_path, self._key_bytes)
+        
+    def key_file_for(self, key_id: str, key_bytes: bytes) -> Path:
+        """Get a key file for FFmpeg that stays fixed for key_id across rotations"""
+        key_path = self.config.storage['private'] / f"encryption_{key_id}.key"
+        self._write_key_file(key_path, key_bytes)
+        return key_path
+        
+    def _write_key_file(self, key_path: Path, key_bytes: bytes):
+        """Write binary key file for FFmpeg (expects 16 bytes, not hex string) unless it already matches"""
+        expected = hashlib.sha256(key_bytes).digest()
+        try:
+            with open(key_path, 'rb') as f:
+                if hashlib.sha256(f.read()).digest() == expected:
+                    return
+        except FileNotFoundError:
+            pass
+        # Replace atomically so a reader never sees a truncated key
+        tmp_path = key_path.with_name(key_path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(key_bytes)
+        os.replace(tmp_path, key_path)
+        logger.info(f"Wrote encryption key file: {key_path}")
+        
+    async def _refresh_key_every(self, interval: int = 3600):
+        """Periodically re-read the active encryption key so rotations are picked up"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                key = await asyncio.to_thread(self.db.get_or_create_encryption_key)
+                if key['key_value'] != self.encryption_key['key_value']:
+                    self.set_encryption_key(key)
+                    logger.info(f"Encryption key refreshed, now using ID: {key['id']}")
+            except Exception as e:
+                logger.error(f"Error refreshing encryption key: {e}")
+                
+    def close(self):
+        """Shut down the worker process pool"""
+        self._pool.shutdown(cancel_futures=True)
+        
+    def detect_video_encoder(self) -> dict:
+        """Select a working hardware H.264 encoder, falling back to libx264"""
+        video_config = self.config.media['video']
+        quality = str(video_config['crf'])
+        vaapi_device = video_config['vaapi_device']
+        candidates = [
+            {
+                'name': 'h264_nvenc',
+                'global_args': [],
+                'codec_args': ['-c:v', 'h264_nvenc', '-rc', 'vbr', '-cq', quality],
+                'filter_suffix': ''
+            },
+            {
+                'name': 'h264_qsv',
+                'global_args': [],
+                'codec_args': ['-c:v', 'h264_qsv', '-global_quality', quality],
+                'filter_suffix': ''
+            },
+            {
+                'name': 'h264_vaapi',
+                'global_args': ['-vaapi_device', vaapi_device],
+                'codec_args': ['-c:v', 'h264_vaapi', '-qp', quality],
+                'filter_suffix': ',format=nv12,hwupload'
+            }
+        ]
+        # Keyframes on HLS segment boundaries (GOP sized for 30 fps) so the
+        # segmenter never has to split mid-GOP
+        segment_duration = video_config['segment_duration']
+        gop = str(segment_duration * 30)
+        software = {
+            'name': 'libx264',
+            'global_args': [],
+            'codec_args': [
+                '-c:v', 'libx264',
+                '-preset', video_config['preset'],
+                '-tune', 'fastdecode',
+                '-profile:v', 'main',
+                '-pix_fmt', 'yuv420p',
+                '-crf', quality,
+                '-g', gop,
+                '-keyint_min', gop,
+                '-sc_threshold', '0',
+                '-force_key_frames', f'expr:gte(t,n_forced*{segment_duration})'
+            ],
+            'filter_suffix': ''
+        }
+        
+        if not video_config['hardware_encoding']:
+            return software
+        
+        try:
+            result = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-encoders'],
+                capture_output=True, text=True, timeout=30
+            )
+            available = result.stdout
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"Could not list FFmpeg encoders: {e}")
+            return software
+        
+        for candidate in candidates:
+            if f" {candidate['name']} " not in available:
+                continue
+            if candidate['name'] == 'h264_vaapi' and not Path(vaapi_device).exists():
+                continue
+            # Encoders are often compiled in without usable hardware; try one frame
+            test_cmd = [
+                'ffmpeg', '-hide_banner', '-loglevel', 'error',
+                *candidate['global_args'],
+                '-f', 'lavfi', '-i', 'color=black:s=256x256:d=0.1',
+                '-vf', f"format=yuv420p{candidate['filter_suffix']}",
+                *candidate['codec_args'],
+                '-frames:v', '1', '-f', 'null', '-'
+            ]
+            try:
+                result = subprocess.run(test_cmd, capture_output=True, timeout=30)
+            except (OSError, subprocess.SubprocessError):
+                continue
+            if result.returncode == 0:
+                return candidate
+            logger.info(f"Hardware encoder {candidate['name']} listed but not usable")
+        
+        return software
+        
+    def detect_hwaccel(self) -> list:
+        """Select a working FFmpeg hardware decoder, returning its input options"""
+        video_config = self.config.media['video']
+        if not video_config['hardware_decoding']:
+            return []
+        vaapi_device = video_config['vaapi_device']
+        
+        try:
+            result = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-hwaccels'],
+                capture_output=True, text=True, timeout=30
+            )
+            available = result.stdout.split()
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"Could not list FFmpeg hwaccels: {e}")
+            return []
+        
+        # Decoded frames are copied back to system memory, so every existing
+        # software filter and encoder keeps working unchanged
+        candidates = [
+            ('cuda', ['-init_hw_device', 'cuda'], ['-hwaccel', 'cuda']),
+            ('vaapi', ['-init_hw_device', f'vaapi=va:{vaapi_device}'],
+             ['-hwaccel', 'vaapi', '-hwaccel_device', vaapi_device])
+        ]
+        for name, init_args, hwaccel_args in candidates:
+            if name not in available:
+                continue
+            if name == 'vaapi' and not Path(vaapi_device).exists():
+                continue
+            # A listed hwaccel still needs a device that can be opened
+            test_cmd = [
+                'ffmpeg', '-hide_banner', '-loglevel', 'error',
+                *init_args,
+                '-f', 'lavfi', '-i', 'color=black:s=64x64:d=0.1',
+                '-frames:v', '1', '-f', 'null', '-'
+            ]
+            try:
+                result = subprocess.run(test_cmd, capture_output=True, timeout=30)
+            except (OSError, subprocess.SubprocessError):
+                continue
+            if result.returncode == 0:
+                return hwaccel_args
+            logger.info(f"Hardware decoder {name} listed but not usable")
+        
+        return []
         
     def generate_file_id(self, file_path: str) -> str:
         """Generate unique ID for file"""
@@ -437,281 +1263,236 @@ class MediaProcessor:
     
     def calculate_file_hash(self, file_path: Path) -> str:
         """Calculate SHA-256 hash of file contents"""
-        sha256_hash = hashlib.sha256()
         with open(file_path, "rb") as f:
-            # Read in chunks to handle large files
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+            # Read/update loop runs in C with large chunks for big media files
+            return hashlib.file_digest(f, 'sha256', _bufsize=HASH_CHUNK_SIZE).hexdigest()
         
     def get_mime_type(self, file_path: Path) -> str:
         """Get MIME type from file extension"""
-        ext = file_path.suffix.lower()
-        mime_types = {
-            '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
-            '.gif': 'image/gif', '.webp': 'image/webp', '.heic': 'image/heic','.dng': 'image/dng',
-            '.mp4': 'video/mp4', '.avi': 'video/avi', '.mov': 'video/quicktime',
-            '.mkv': 'video/x-matroska', '.webm': 'video/webm'
-        }
-        return mime_types.get(ext, 'application/octet-stream')
+        return MIME_TYPES.get(file_path.suffix.lower(), 'application/octet-stream')
         
     async def process_file(self, file_path: Path):
         """Process a single file"""
         try:
             logger.info(f"Processing file: {file_path}")
             
-            # Update queue status
-            self.db.update_queue_status(str(file_path), 'processing')
-            
-            # Calculate file hash first to check for duplicates
-            file_hash = self.calculate_file_hash(file_path)
-            logger.info(f"File hash: {file_hash}")
-            
-            # Check if this file already exists
-            duplicate = self.db.check_duplicate_by_hash(file_hash)
-            if duplicate:
-                logger.warning(f"Duplicate file detected: {file_path.name} matches existing file '{duplicate['original_name']}' (ID: {duplicate['id']})")
-                # Mark as completed in queue and remove the duplicate file
-                self.db.update_queue_status(str(file_path), 'completed', f"Duplicate of existing file ID: {duplicate['id']}")
-                file_path.unlink()
-                logger.info(f"Removed duplicate file: {file_path}")
-                return
-            
+            # Determine file type
+            ext = file_path.suffix.lower()
+            file_type = self.config.get_file_type(ext)
+            if file_type is None:
+                raise ValueError(f"Unsupported file type: {ext}")
+                
             # Get file info
             file_stats = file_path.stat()
+            if file_stats.st_size == 0:
+                raise ValueError("File is empty")
+            
+            # A fingerprint hit on an image is most likely a re-import; confirm it
+            # with the full hash (the fingerprint only samples the file) and skip
+            # the encode. Videos already check the hash before transcoding.
+            fingerprint = file_hash = None
+            if file_type == 'image':
+                fingerprint = await asyncio.to_thread(_content_fingerprint, file_path, file_stats)
+                duplicate = await self.async_db.check_duplicate_by_fingerprint(fingerprint)
+                if duplicate:
+                    file_hash = await asyncio.to_thread(self.calculate_file_hash, file_path)
+                    if file_hash == duplicate['file_hash']:
+                        await self.discard_duplicate(file_path, duplicate)
+                        return
+                
             file_id = self.generate_file_id(str(file_path))
             mime_type = self.get_mime_type(file_path)
             
-            # Use the cached encryption key, but refresh it from DB to ensure it exists
-            encryption_key = self.db.get_or_create_encryption_key()
-            logger.info(f"Using encryption key ID: {encryption_key['id']}")
+            # Pin the cached key for the whole job; rotations by _refresh_key_every
+            # only apply to jobs started afterwards
+            key_id, key_bytes = self._key_id, self._key_bytes
+            logger.info(f"Using encryption key ID: {key_id}")
             
-            # Determine file type
-            ext = file_path.suffix.lower()
-            if ext in self.config.media['image']['extensions']:
-                result = await self.process_image(file_path, file_id, encryption_key)
-                file_type = 'image'
-            elif ext in self.config.media['video']['extensions']:
-                result = await self.process_video(file_path, file_id, encryption_key)
-                file_type = 'video'
+            # Hash the source in a worker thread (unless the fingerprint check
+            # already did) while images are decoded, encoded and encrypted in the
+            # process pool. Nothing is written to disk until the duplicate check
+            # below has passed.
+            tasks = []
+            if file_hash is None:
+                tasks.append(asyncio.to_thread(self.calculate_file_hash, file_path))
+            if file_type == 'image':
+                tasks.append(self._run_in_pool(
+                    _process_image_worker, str(file_path), key_bytes, self.config.media
+                ))
+            outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+            for outcome in outcomes:
+                if isinstance(outcome, BaseException):
+                    raise outcome
+            if file_hash is None:
+                file_hash, *encoded = outcomes
             else:
-                raise ValueError(f"Unsupported file type: {ext}")
-                
-            # Verify encryption key exists before saving metadata
-            key_check = self.db.fetch_one(
-                "SELECT id FROM encryption_keys WHERE id = %s",
-                (encryption_key['id'],)
-            )
-            if not key_check:
-                logger.error(f"Encryption key {encryption_key['id']} does not exist in database!")
-                raise Exception(f"Encryption key {encryption_key['id']} not found in database")
+                encoded = outcomes
+            logger.info(f"File hash: {file_hash}")
             
+            # Check if this file already exists before writing any output
+            duplicate = await self.async_db.check_duplicate_by_hash(file_hash)
+            if duplicate:
+                await self.discard_duplicate(file_path, duplicate)
+                return
+            
+            if file_type == 'image':
+                result = await self.process_image(file_id, encoded[0])
+            else:
+                result = await self.process_video(file_path, file_id, key_id, key_bytes)
+                
             # Save metadata
             metadata = {
                 'id': file_id,
                 'original_name': file_path.name,
                 'file_hash': file_hash,
+                'content_fingerprint': fingerprint,
                 'file_type': file_type,
                 'mime_type': mime_type,
                 'file_size_bytes': file_stats.st_size,
-                'encryption_key_id': encryption_key['id'],
+                'encryption_key_id': key_id,
                 **result
             }
             
-            logger.info(f"Saving media metadata with encryption_key_id: {encryption_key['id']}")
-            self.db.save_media_metadata(metadata)
-            
-            # Update queue status
-            self.db.update_queue_status(str(file_path), 'completed')
+            # The encryption_key_id foreign key rejects the insert if the key is missing
+            logger.info(f"Saving media metadata with encryption_key_id: {key_id}")
+            try:
+                await self.async_db.complete_media_file(str(file_path), metadata)
+            except UNIQUE_VIOLATIONS:
+                # A concurrent job stored the same content first
+                duplicate = await self.async_db.check_duplicate_by_hash(file_hash)
+                if not duplicate:
+                    raise
+                self.remove_outputs(file_id, file_type)
+                await self.discard_duplicate(file_path, duplicate)
+                return
             
             # Remove original file
             file_path.unlink()
+            if file_type == 'video':
+                await self.forget_video_info(file_path)
             logger.info(f"Successfully processed: {file_path.name}")
             
         except Exception as e:
             logger.error(f"Error processing {file_path}: {e}")
-            self.db.update_queue_status(str(file_path), 'failed', str(e))
-            
-    async def process_image(self, input_path: Path, image_id: str, encryption_key: dict) -> dict:
-        """Process image file"""
-        output_path = self.config.storage['images'] / f"{image_id}.webp"
-        thumbnail_path = self.config.storage['images'] / f"{image_id}_thumb.webp"
-        
-        # Open and convert image
-        with Image.open(input_path) as img:
-            # Convert to RGB if necessary
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1])
-                img = background
-            elif img.mode not in ('RGB',):
-                img = img.convert('RGB')
-                
-            # Save original dimensions
-            original_width, original_height = img.size
-            
-            # Resize if needed for main image
-            max_width = self.config.media['image']['max_width']
-            max_height = self.config.media['image']['max_height']
+            await self.async_db.update_queue_status(str(file_path), 'failed', str(e))
             
-            if img.width > max_width or img.height > max_height:
-                img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-                
-            # Save as WebP
-            img.save(output_path, 'WEBP', quality=self.config.media['image']['quality'])
-            
-            width, height = img.size
-            
-        # Generate thumbnail
-        self.generate_image_thumbnail(input_path, thumbnail_path)
+    async def discard_duplicate(self, file_path: Path, duplicate: dict):
+        """Mark a duplicate import completed and remove it"""
+        logger.warning(f"Duplicate file detected: {file_path.name} matches existing file '{duplicate['original_name']}' (ID: {duplicate['id']})")
+        # Mark as completed in queue and remove the duplicate file
+        await self.async_db.update_queue_status(str(file_path), 'completed', f"Duplicate of existing file ID: {duplicate['id']}")
+        file_path.unlink()
+        logger.info(f"Removed duplicate file: {file_path}")
+        
+    def remove_outputs(self, file_id: str, file_type: str):
+        """Delete the encrypted outputs of a file that will not be recorded"""
+        if file_type == 'video':
+            shutil.rmtree(self.config.storage['videos'] / file_id, ignore_errors=True)
+        else:
+            for name in (f"{file_id}.webp.enc", f"{file_id}_thumb.webp.enc"):
+                (self.config.storage['images'] / name).unlink(missing_ok=True)
+        logger.info(f"Removed outputs of {file_id}")
+        
+    async def process_image(self, image_id: str, encoded: dict) -> dict:
+        """Write the encrypted image and thumbnail produced by _process_image_worker"""
+        output_path = self.config.storage['images'] / f"{image_id}.webp.enc"
+        thumbnail_path = self.config.storage['images'] / f"{image_id}_thumb.webp.enc"
         
-        # Encrypt both the image and thumbnail
-        encrypted_path = self.encrypt_file(output_path, encryption_key['key_value'])
-        encrypted_thumbnail = self.encrypt_file(thumbnail_path, encryption_key['key_value'])
+        output_path.write_bytes(encoded['image'])
+        thumbnail_path.write_bytes(encoded['thumbnail'])
+        logger.info(f"Encrypted image created: {output_path} ({len(encoded['image'])} bytes)")
         
         return {
-            'width': width,
-            'height': height,
+            'width': encoded['width'],
+            'height': encoded['height'],
             'storage_path': f"images/{image_id}.webp.enc",
             'thumbnail_path': f"images/{image_id}_thumb.webp.enc"
         }
         
-    def encrypt_file(self, file_path: Path, key_hex: str) -> Path:
-        """Encrypt file with AES-128"""
-        encrypted_path = file_path.with_suffix(file_path.suffix + '.enc')
-        
-        # Check if file exists and has content
-        if not file_path.exists():
-            logger.error(f"File to encrypt does not exist: {file_path}")
-            # Create a minimal placeholder encrypted file
-            # This is a 1x1 black WebP encrypted with zeros IV
-            placeholder_webp = b'RIFF$\x00\x00\x00WEBPVP8 \x18\x00\x00\x000\x01\x00\x9d\x01*\x01\x00\x01\x00\x01@%\xa4\x00\x03p\x00\xfe\xfb\x94\x00\x00'
-            key = bytes.fromhex(key_hex)
-            iv = b'\x00' * 16
-            
-            # Pad and encrypt placeholder
-            pad_len = 16 - (len(placeholder_webp) % 16)
-            padded = placeholder_webp + bytes([pad_len]) * pad_len
-            
-            cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-            encryptor = cipher.encryptor()
-            ciphertext = encryptor.update(padded) + encryptor.finalize()
-            
-            with open(encrypted_path, 'wb') as f:
-                f.write(iv + ciphertext)
-            
-            logger.warning(f"Created placeholder encrypted file: {encrypted_path}")
-            return encrypted_path
-            
-        file_size = file_path.stat().st_size
-        if file_size == 0:
-            logger.error(f"File to encrypt is empty: {file_path}")
-            # Handle same as non-existent file
-            file_path.unlink()  # Remove empty file
-            return self.encrypt_file(Path("non-existent"), key_hex)  # Recursive call to create placeholder
-        
-        if file_size < 100:
-            logger.warning(f"File to encrypt is suspiciously small ({file_size} bytes): {file_path}")
-            
-        key = bytes.fromhex(key_hex)
-        iv = os.urandom(16)
+    async def encrypt_file(self, file_path: Path, key: bytes) -> Path:
+        """Encrypt file with AES-128-CBC in the worker process pool"""
+        return await self._run_in_pool(_encrypt_file, file_path, key)
+        
+    def _create_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        """Start the worker process pool"""
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context('spawn')
+        )
         
-        # Read file
+    async def _run_in_pool(self, fn, *args):
+        """Run fn in the worker process pool, replacing the pool if a worker died"""
+        loop = asyncio.get_running_loop()
+        pool = self._pool
         try:
-            with open(file_path, 'rb') as f:
-                plaintext = f.read()
-                
-            logger.info(f"Encrypting file: {file_path} ({len(plaintext)} bytes)")
-            
-            # Pad data to 16-byte boundary
-            pad_len = 16 - (len(plaintext) % 16)
-            plaintext += bytes([pad_len]) * pad_len
-            
-            # Encrypt
-            cipher = Cipher(
-                algorithms.AES(key),
-                modes.CBC(iv),
-                backend=default_backend()
-            )
-            encryptor = cipher.encryptor()
-            ciphertext = encryptor.update(plaintext) + encryptor.finalize()
-            
-            # Write encrypted file (IV + ciphertext)
-            with open(encrypted_path, 'wb') as f:
-                f.write(iv + ciphertext)
-                
-            encrypted_size = encrypted_path.stat().st_size
-            logger.info(f"Encrypted file created: {encrypted_path} ({encrypted_size} bytes)")
-            
-            # Validate encrypted file
-            if encrypted_size < 32:  # Minimum size: 16 bytes IV + 16 bytes data
-                logger.error(f"Encrypted file too small: {encrypted_size} bytes")
-                
-            # Remove original only if encryption was successful
-            file_path.unlink()
-            
-        except Exception as e:
-            logger.error(f"Encryption failed for {file_path}: {e}")
-            # Create placeholder if encryption fails
-            if encrypted_path.exists():
-                encrypted_path.unlink()
-            return self.encrypt_file(Path("non-existent"), key_hex)
-        
-        return encrypted_path
-        
-    def generate_image_thumbnail(self, input_path: Path, output_path: Path):
-        """Generate thumbnail for image"""
-        with Image.open(input_path) as img:
-            # Convert to RGB if necessary
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1])
-                img = background
-            elif img.mode not in ('RGB',):
-                img = img.convert('RGB')
-            
-            # Create thumbnail with fixed width
-            thumbnail_width = self.config.media['thumbnail']['width']
-            
-            # Calculate proportional height
-            aspect_ratio = img.height / img.width
-            thumbnail_height = int(thumbnail_width * aspect_ratio)
-            
-            # Resize for thumbnail
-            img_thumb = img.resize((thumbnail_width, thumbnail_height), Image.Resampling.LANCZOS)
-            
-            # Save thumbnail as WebP
-            img_thumb.save(output_path, 'WEBP', quality=self.config.media['thumbnail']['quality'])
+            return await loop.run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            # A killed worker (OOM, crash in libheif/libvips) breaks the executor
+            # for good; swap in a fresh one and fail only the jobs that were using it
+            if self._pool is pool:
+                logger.error("A worker process died, restarting the process pool")
+                self._pool = self._create_pool()
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise
         
-    async def process_video(self, input_path: Path, video_id: str, encryption_key: dict) -> dict:
+    async def process_video(self, input_path: Path, video_id: str, key_id: str, key_bytes: bytes) -> dict:
         """Process video with HLS encryption and animated thumbnails"""
         output_dir = self.config.storage['videos'] / video_id
         output_dir.mkdir(parents=True, exist_ok=True)
         
         # Get video information
-        duration, width, height = self.get_video_info(input_path)
+        duration, width, height = await self.load_video_info(input_path)
         
         # Generate unique IV for this video
         iv = secrets.token_hex(16)
         
         # Create key info file
-        key_info_path = self.create_key_info_file(video_id, iv)
+        key_info_path = self.create_key_info_file(video_id, iv, self.key_file_for(key_id, key_bytes))
         
-        # Generate animated thumbnails first (in parallel)
-        thumbnail_task = asyncio.create_task(
-            asyncio.to_thread(
-                self.generate_animated_thumbnail,
-                input_path, output_dir, video_id, duration
-            )
-        )
+        thumbnail_path = output_dir / 'thumbnail.webp'
+        preview_path = output_dir / 'preview.webp'
+        thumbnail_config = self.config.media['thumbnail']
+        preview_config = self.config.media['preview']
         
-        # FFmpeg command with HLS encryption
+        # Calculate start time (skip first 10% of video), keeping the
+        # thumbnail window inside the video
+        start_time = max(5, duration * 0.1)  # Start at 10% or 5 seconds
+        start_time = max(0, min(start_time, duration - thumbnail_config['duration']))
+        
+        # Fit within 1280x720 with even dimensions; a constant scale avoids
+        # per-frame expression evaluation in the filter graph
+        if width and height:
+            scale = min(1, 1280 / width, 720 / height)
+            scale_filter = f'scale={int(width * scale) // 2 * 2}:{int(height * scale) // 2 * 2}'
+        else:
+            scale_filter = 'scale=w=trunc(iw*min(1\\,min(1280/iw\\,720/ih))/2)*2:h=trunc(ih*min(1\\,min(1280/iw\\,720/ih))/2)*2'
+        
+        # Decode the source once and split it into the HLS stream, the 3-second
+        # animated thumbnail and the sampled preview
+        encoder = self.video_encoder
+        filter_graph = ';'.join([
+            '[0:v]split=3[main][thumb][prev]',
+            f'[main]{scale_filter}{encoder["filter_suffix"]}[hls]',
+            f"[thumb]trim=start={start_time}:duration={thumbnail_config['duration']},setpts=PTS-STARTPTS,"
+            f"fps={thumbnail_config['fps']},scale={thumbnail_config['width']}:-1:flags=lanczos[thumbout]",
+            f"[prev]trim=start={start_time}:duration=10,setpts=PTS-STARTPTS,"
+            f"fps=1,scale={preview_config['width']}:-1:flags=lanczos,"
+            f"select='not(mod(n\\,{int(preview_config['fps'])}))'[prevout]"
+        ])
+        
+        # FFmpeg command with HLS encryption plus both WebP outputs
         cmd = [
-            'ffmpeg', '-i', str(input_path),
-            '-vf', f'scale=w=trunc(iw*min(1\\,min(1280/iw\\,720/ih))/2)*2:h=trunc(ih*min(1\\,min(1280/iw\\,720/ih))/2)*2',
-            '-c:v', 'libx264',
-            '-preset', self.config.media['video']['preset'],
-            '-crf', str(self.config.media['video']['crf']),
+            'ffmpeg',
+            *FFMPEG_QUIET_ARGS,
+            '-progress', 'pipe:1',
+            *encoder['global_args'],
+            *self.hwaccel_args,
+            '-i', str(input_path),
+            '-filter_complex', filter_graph,
+            # HLS output
+            '-map', '[hls]', '-map', '0:a:0?',
+            *encoder['codec_args'],
+            '-threads', str(self.config.processing['ffmpeg_threads']),
             '-c:a', 'aac',
             '-b:a', self.config.media['video']['audio_bitrate'],
             '-hls_time', str(self.config.media['video']['segment_duration']),
@@ -720,21 +1501,59 @@ class MediaProcessor:
             '-hls_key_info_file', str(key_info_path),
             '-hls_segment_type', 'mpegts',
             '-hls_flags', 'delete_segments+independent_segments',
-            str(output_dir / 'stream.m3u8')
+            str(output_dir / 'stream.m3u8'),
+            # Animated thumbnail output
+            '-map', '[thumbout]',
+            '-c:v', 'libwebp',
+            '-lossless', '0',
+            '-compression_level', str(thumbnail_config['method']),
+            '-quality', str(thumbnail_config['quality']),
+            '-threads', '1',  # Jobs already run in parallel
+            '-loop', '0',
+            str(thumbnail_path),
+            # Preview output
+            '-map', '[prevout]',
+            '-frames:v', str(preview_config['max_frames']),
+            '-c:v', 'libwebp',
+            '-lossless', '0',
+            '-compression_level', str(preview_config['method']),
+            '-quality', str(preview_config['quality']),
+            '-threads', '1',
+            '-loop', '0',
+            str(preview_path)
         ]
         
-        # Execute FFmpeg for HLS
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            raise Exception(f"FFmpeg error: {result.stderr}")
+        # Execute FFmpeg without blocking the event loop
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"Transcoding HLS with thumbnails: {shlex.join(cmd)}")
+        async with self._ffmpeg_slots:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stderr_task = asyncio.create_task(proc.stderr.read())
+            progress = {}
+            async for line in proc.stdout:
+                key, _, value = line.decode(errors='replace').strip().partition('=')
+                progress[key] = value
+                if key == 'progress':
+                    logger.debug("FFmpeg progress for %s: out_time=%s speed=%s",
+                                 video_id, progress.get('out_time'), progress.get('speed'))
+            stderr = await stderr_task
+            await proc.wait()
+        
+        if proc.returncode != 0:
+            raise Exception(f"FFmpeg error: {stderr.decode(errors='replace')}")
             
-        # Wait for thumbnail generation
-        thumbnail_path, preview_path = await thumbnail_task
+        # Fall back to static thumbnails for anything the single pass missed
+        await self.ensure_video_thumbnails(input_path, thumbnail_path, preview_path, start_time)
         
         # Encrypt thumbnails
-        encrypted_thumbnail = self.encrypt_file(thumbnail_path, encryption_key['key_value'])
-        encrypted_preview = self.encrypt_file(preview_path, encryption_key['key_value'])
+        await asyncio.gather(
+            self.encrypt_file(thumbnail_path, key_bytes),
+            self.encrypt_file(preview_path, key_bytes)
+        )
         
         # Clean up temporary key info file
         key_info_path.unlink()
@@ -749,31 +1568,72 @@ class MediaProcessor:
             'extra_metadata': {'iv': iv}
         }
         
-    def get_video_info(self, input_path: Path) -> Tuple[float, int, int]:
-        """Get video duration and dimensions"""
+    async def load_video_info(self, input_path: Path) -> Tuple[float, int, int]:
+        """Get video info from the probe cache, probing and caching on a miss"""
+        file_stats = input_path.stat()
+        cache_key = (str(input_path), file_stats.st_size, file_stats.st_mtime_ns)
+        try:
+            cached = await self.async_db.get_video_metadata(*cache_key)
+            if cached:
+                logger.info(f"Using cached video info for {input_path.name}")
+                return cached['duration'], cached['width'], cached['height']
+        except DB_ERRORS as e:
+            logger.warning(f"Video metadata cache lookup failed: {e}")
+            
+        duration, width, height = await self.get_video_info(input_path)
+        try:
+            await self.async_db.save_video_metadata(
+                *cache_key, {'duration': duration, 'width': width, 'height': height}
+            )
+        except DB_ERRORS as e:
+            logger.warning(f"Failed to cache video metadata: {e}")
+        return duration, width, height
+        
+    async def forget_video_info(self, input_path: Path):
+        """Drop the probe cache entry of a video that has left the imports directory"""
+        try:
+            await self.async_db.delete_video_metadata(str(input_path))
+        except DB_ERRORS as e:
+            logger.warning(f"Failed to drop cached video metadata: {e}")
+        
+    async def get_video_info(self, input_path: Path) -> Tuple[float, int, int]:
+        """Get video duration and displayed dimensions from a single ffprobe call"""
         cmd = [
             'ffprobe', '-v', 'error',
+            # Only the first video stream is used; skip serialising the rest
             '-select_streams', 'v:0',
-            '-show_entries', 'stream=width,height,duration',
-            '-of', 'json',
+            '-print_format', 'json',
+            # Serialise just the fields read below instead of every stream and
+            # format entry and tag
+            '-show_entries',
+            'stream=codec_type,width,height,duration:stream_tags=rotate:'
+            'stream_side_data=rotation:format=duration',
             str(input_path)
         ]
         
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        data = json.loads(result.stdout)
+        _, stdout, _ = await _run_process(cmd)
+        data = json.loads(stdout or b'{}')
         
-        if not data.get('streams'):
+        video_streams = [s for s in data.get('streams', []) if s.get('codec_type') == 'video']
+        if not video_streams:
             raise ValueError("No video stream found")
             
-        stream = data['streams'][0]
-        
-        return (
-            float(stream.get('duration', 0)),
-            int(stream.get('width', 0)),
-            int(stream.get('height', 0))
-        )
-        
-    def create_key_info_file(self, video_id: str, iv: str) -> Path:
+        stream = video_streams[0]
+        # Matroska/WebM only carry the duration on the container
+        duration = float(stream.get('duration') or data.get('format', {}).get('duration') or 0)
+        width = int(stream.get('width', 0))
+        height = int(stream.get('height', 0))
+        
+        # FFmpeg autorotates, so report the dimensions as displayed
+        rotation = stream.get('tags', {}).get('rotate', 0)
+        for side_data in stream.get('side_data_list', []):
+            rotation = side_data.get('rotation', rotation)
+        if abs(int(float(rotation))) % 180 == 90:
+            width, height = height, width
+        
+        return duration, width, height
+        
+    def create_key_info_file(self, video_id: str, iv: str, key_path: Path) -> Path:
         """Create key_info.txt for FFmpeg HLS encryption"""
         key_info_path = self.config.storage['private'] / f"key_info_{video_id}.txt"
         
@@ -784,127 +1644,122 @@ class MediaProcessor:
             # URL where the player will fetch the key
             f.write(f"{base_url}/api/media/keys/{video_id}\n")
             # Local path to encryption key
-            f.write(f"{self.encryption_key_path}\n")
+            f.write(f"{key_path}\n")
             # IV for this specific video
             f.write(f"{iv}\n")
             
         return key_info_path
         
-    def generate_animated_thumbnail(self, input_path: Path, output_dir: Path, 
-                                   video_id: str, duration: float) -> Tuple[Path, Path]:
-        """Generate animated WebP thumbnail"""
-        thumbnail_path = output_dir / 'thumbnail.webp'
-        preview_path = output_dir / 'preview.webp'
-        
-        # Calculate start time (skip first 10% of video)
-        start_time = max(5, duration * 0.1)  # Start at 10% or 5 seconds
-        
-        # First try to generate animated thumbnails
-        animated_success = False
-        
-        # Generate 3-second animated thumbnail with improved settings
-        cmd_thumbnail = [
-            'ffmpeg', '-i', str(input_path),
-            '-ss', str(start_time),
-            '-t', str(self.config.media['thumbnail']['duration']),
-            '-vf', f"fps={self.config.media['thumbnail']['fps']},scale={self.config.media['thumbnail']['width']}:-1:flags=lanczos",
-            '-c:v', 'libwebp',  # Explicitly specify WebP codec
-            '-lossless', '0',   # Use lossy compression
-            '-compression_level', str(self.config.media['thumbnail']['compression_level']),
-            '-quality', str(self.config.media['thumbnail']['quality']),
-            '-preset', 'default',
-            '-loop', '0',  # Infinite loop
-            '-an',  # No audio
-            '-vsync', '0',  # Passthrough timestamps
-            str(thumbnail_path)
-        ]
-        
-        # Execute thumbnail generation
-        logger.info(f"Generating animated thumbnail with command: {' '.join(cmd_thumbnail)}")
-        result_thumb = subprocess.run(cmd_thumbnail, capture_output=True, text=True)
-        
-        if result_thumb.returncode != 0:
-            logger.error(f"Animated thumbnail generation failed: {result_thumb.stderr}")
-            # Create a simple static thumbnail as fallback
-            self.create_static_thumbnail(input_path, thumbnail_path, start_time)
-        else:
-            animated_success = True
-            # Verify file size
-            if thumbnail_path.exists() and thumbnail_path.stat().st_size > 1000:
-                logger.info(f"Animated thumbnail created successfully: {thumbnail_path.stat().st_size} bytes")
-            else:
-                logger.error(f"Animated thumbnail too small or missing, creating static fallback")
-                self.create_static_thumbnail(input_path, thumbnail_path, start_time)
-                animated_success = False
-        
-        # For preview, use a simpler approach if animated thumbnails are failing
-        if animated_success:
-            # Try scene-based preview with simpler settings
-            cmd_preview = [
-                'ffmpeg', '-i', str(input_path),
-                '-ss', str(start_time),
-                '-t', '10',  # Sample 10 seconds
-                '-vf', f"fps=1,scale={self.config.media['preview']['width']}:-1:flags=lanczos,select='not(mod(n\\,{int(self.config.media['preview']['fps'])}))'",
-                '-frames:v', str(self.config.media['preview']['max_frames']),
-                '-c:v', 'libwebp',
-                '-lossless', '0',
-                '-compression_level', str(self.config.media['preview']['compression_level']),
-                '-quality', str(self.config.media['preview']['quality']),
-                '-preset', 'default',
-                '-loop', '0',
-                '-an',
-                '-vsync', '0',
-                str(preview_path)
-            ]
-            
-            logger.info(f"Generating preview with command: {' '.join(cmd_preview)}")
-            result_preview = subprocess.run(cmd_preview, capture_output=True, text=True)
+    async def ensure_video_thumbnails(self, input_path: Path, thumbnail_path: Path,
+                                      preview_path: Path, start_time: float):
+        """Replace missing or broken animated thumbnail/preview with static fallbacks"""
+        thumbnail_size = _file_size(thumbnail_path)
+        preview_size = _file_size(preview_path)
+        if thumbnail_size <= 1000 or preview_size <= 1000:
+            logger.warning("Animated thumbnail or preview missing after transcode, retrying with a seeked pass")
+            await self.generate_animated_thumbnails(input_path, thumbnail_path, preview_path, start_time)
+            thumbnail_size = _file_size(thumbnail_path)
+            preview_size = _file_size(preview_path)
             
-            if result_preview.returncode != 0:
-                logger.error(f"Preview generation failed: {result_preview.stderr}")
-                # Use thumbnail as preview if preview generation fails
-                if thumbnail_path.exists() and thumbnail_path.stat().st_size > 1000:
-                    import shutil
-                    shutil.copy(thumbnail_path, preview_path)
-                else:
-                    self.create_static_thumbnail(input_path, preview_path, start_time + 5)
+        if thumbnail_size > 1000:
+            logger.info(f"Animated thumbnail created successfully: {thumbnail_size} bytes")
         else:
-            # If animated thumbnails aren't working, just create static previews
-            logger.info("Skipping animated preview due to thumbnail issues, creating static preview")
-            self.create_static_thumbnail(input_path, preview_path, start_time + 5)
+            logger.error(f"Animated thumbnail too small or missing, creating static fallback")
+            await self.create_static_thumbnail(input_path, thumbnail_path, start_time)
+            thumbnail_size = _file_size(thumbnail_path)
+            
+        if preview_size <= 1000:
+            logger.error(f"Preview too small or missing")
+            # Use thumbnail as preview if preview generation fails
+            if thumbnail_size > 1000:
+                shutil.copyfile(thumbnail_path, preview_path)
+                preview_size = thumbnail_size
+            else:
+                await self.create_static_thumbnail(input_path, preview_path, start_time + 5)
+                preview_size = _file_size(preview_path)
         
         # Validate generated files
-        for path, name in [(thumbnail_path, "thumbnail"), (preview_path, "preview")]:
-            if not path.exists():
+        for path, name, size in [(thumbnail_path, "thumbnail", thumbnail_size), (preview_path, "preview", preview_size)]:
+            if size == 0:
                 logger.error(f"{name} file not created, generating fallback")
-                self.create_static_thumbnail(input_path, path, start_time)
-            elif path.stat().st_size < 1000:
-                logger.error(f"{name} file too small ({path.stat().st_size} bytes), regenerating")
-                self.create_static_thumbnail(input_path, path, start_time)
-        
-        return thumbnail_path, preview_path
+                await self.create_static_thumbnail(input_path, path, start_time)
+            elif size < 1000:
+                logger.error(f"{name} file too small ({size} bytes), regenerating")
+                await self.create_static_thumbnail(input_path, path, start_time)
     
-    def create_static_thumbnail(self, input_path: Path, output_path: Path, start_time: float):
+    async def generate_animated_thumbnails(self, input_path: Path, thumbnail_path: Path,
+                                           preview_path: Path, start_time: float):
+        """Generate the animated thumbnail and preview from one fast-seeked decode"""
+        thumbnail_config = self.config.media['thumbnail']
+        preview_config = self.config.media['preview']
+        filter_graph = ';'.join([
+            '[0:v]split=2[thumb][prev]',
+            f"[thumb]fps={thumbnail_config['fps']},scale={thumbnail_config['width']}:-1:flags=lanczos[thumbout]",
+            f"[prev]fps=1,scale={preview_config['width']}:-1:flags=lanczos,"
+            f"select='not(mod(n\\,{int(preview_config['fps'])}))'[prevout]"
+        ])
+        
+        # -ss before -i seeks to the nearest keyframe instead of decoding from the start
+        cmd = [
+            'ffmpeg', *FFMPEG_QUIET_ARGS,
+            '-ss', str(start_time),
+            '-t', '10',
+            *self.hwaccel_args,
+            '-i', str(input_path),
+            '-filter_complex', filter_graph,
+            '-map', '[thumbout]',
+            '-t', str(thumbnail_config['duration']),
+            '-c:v', 'libwebp',
+            '-lossless', '0',
+            '-compression_level', str(thumbnail_config['method']),
+            '-quality', str(thumbnail_config['quality']),
+            '-threads', '1',
+            '-loop', '0',
+            '-y', str(thumbnail_path),
+            '-map', '[prevout]',
+            '-frames:v', str(preview_config['max_frames']),
+            '-c:v', 'libwebp',
+            '-lossless', '0',
+            '-compression_level', str(preview_config['method']),
+            '-quality', str(preview_config['quality']),
+            '-threads', '1',
+            '-loop', '0',
+            '-y', str(preview_path)
+        ]
+        
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"Generating animated thumbnails: {shlex.join(cmd)}")
+        async with self._ffmpeg_slots:
+            returncode, _, stderr = await _run_process(cmd)
+        if returncode != 0:
+            logger.error(f"Animated thumbnail generation failed: {stderr.decode(errors='replace')}")
+            
+    async def create_static_thumbnail(self, input_path: Path, output_path: Path, start_time: float):
         """Create a static thumbnail as fallback"""
-        # Try different approaches to ensure we get a valid thumbnail
+        # Try different approaches to ensure we get a valid thumbnail; -ss
+        # before -i seeks by keyframe instead of decoding from the start
         attempts = [
             # Attempt 1: Standard static WebP
             [
-                'ffmpeg', '-i', str(input_path),
+                'ffmpeg', *FFMPEG_QUIET_ARGS,
                 '-ss', str(start_time),
+                *self.hwaccel_args,
+                '-i', str(input_path),
                 '-vframes', '1',  # Extract single frame
                 '-vf', f"scale={self.config.media['thumbnail']['width']}:-1:flags=lanczos",
                 '-c:v', 'libwebp',
                 '-lossless', '0',
-                '-compression_level', str(self.config.media['thumbnail']['compression_level']),
+                '-compression_level', str(self.config.media['thumbnail']['method']),
                 '-quality', str(self.config.media['thumbnail']['quality']),
+                '-threads', '1',
                 '-y',  # Overwrite output
                 str(output_path)
             ],
             # Attempt 2: Try without explicit codec
             [
-                'ffmpeg', '-i', str(input_path),
+                'ffmpeg', *FFMPEG_QUIET_ARGS,
                 '-ss', str(max(0, start_time - 2)),  # Try a bit earlier
+                '-i', str(input_path),
                 '-vframes', '1',
                 '-vf', f"scale={self.config.media['thumbnail']['width']}:-1:flags=lanczos",
                 '-y',
@@ -914,114 +1769,167 @@ class MediaProcessor:
         
         success = False
         for i, cmd in enumerate(attempts):
-            logger.info(f"Static thumbnail attempt {i+1}: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f"Static thumbnail attempt {i+1}: {shlex.join(cmd)}")
+            async with self._ffmpeg_slots:
+                returncode, _, stderr = await _run_process(cmd)
             
-            if result.returncode == 0:
+            if returncode == 0:
                 # Check if file was created successfully
-                if output_path.exists() and output_path.stat().st_size > 1000:
+                output_size = _file_size(output_path)
+                if output_size > 1000:
                     success = True
-                    logger.info(f"Successfully created static thumbnail: {output_path.stat().st_size} bytes")
+                    logger.info(f"Successfully created static thumbnail: {output_size} bytes")
                     break
                 else:
                     logger.error(f"Attempt {i+1} created file too small or missing")
             else:
-                logger.error(f"Attempt {i+1} failed: {result.stderr}")
+                logger.error(f"Attempt {i+1} failed: {stderr.decode(errors='replace')}")
         
         if not success:
             logger.error(f"All thumbnail generation attempts failed, creating placeholder")
-            # Create a placeholder image
-            try:
-                from PIL import Image, ImageDraw
-                img = Image.new('RGB', (320, 180), color='#1a1a1a')
-                draw = ImageDraw.Draw(img)
-                # Add a simple icon or text
-                draw.rectangle([(140, 70), (180, 110)], outline='#666666', width=2)
-                draw.polygon([(150, 80), (170, 90), (150, 100)], fill='#666666')
-                img.save(output_path, 'WEBP', quality=80)
-                logger.info(f"Created placeholder thumbnail: {output_path}")
-            except Exception as e:
-                logger.error(f"Failed to create placeholder: {e}")
-                # Last resort: create minimal WebP
-                with open(output_path, 'wb') as f:
-                    # This is a minimal valid WebP file (1x1 black pixel)
-                    f.write(b'RIFF$\x00\x00\x00WEBPVP8 \x18\x00\x00\x000\x01\x00\x9d\x01*\x01\x00\x01\x00\x01@%\xa4\x00\x03p\x00\xfe\xfb\x94\x00\x00')
+            output_path.write_bytes(self._placeholder_bytes)
+            logger.info(f"Created placeholder thumbnail: {output_path}")
+            
+    def _render_placeholder_thumbnail(self) -> bytes:
+        """Render the placeholder WebP used when every thumbnail attempt fails"""
+        try:
+            img = Image.new('RGB', (320, 180), color='#1a1a1a')
+            draw = ImageDraw.Draw(img)
+            # Add a simple icon or text
+            draw.rectangle([(140, 70), (180, 110)], outline='#666666', width=2)
+            draw.polygon([(150, 80), (170, 90), (150, 100)], fill='#666666')
+            buffer = io.BytesIO()
+            img.save(buffer, 'WEBP', quality=80)
+            return buffer.getvalue()
+        except Exception as e:
+            logger.error(f"Failed to create placeholder: {e}")
+            # Last resort: a minimal valid WebP file (1x1 black pixel)
+            return b'RIFF$\x00\x00\x00WEBPVP8 \x18\x00\x00\x000\x01\x00\x9d\x01*\x01\x00\x01\x00\x01@%\xa4\x00\x03p\x00\xfe\xfb\x94\x00\x00'
 
 
 class FileWatcher(FileSystemEventHandler):
-    """Watch for new files in imports directory"""
-    def __init__(self, processor: MediaProcessor, db: DatabaseManager):
+    """Watch for new files in imports directory.
+    
+    New files are buffered and flushed to the processing queue in batches by
+    a background thread, so dropping a large folder does not cost one INSERT
+    per file.
+    """
+    flush_interval = 0.25  # seconds
+    
+    def __init__(self, processor: MediaProcessor, db: DatabaseManager, scan_event: asyncio.Event = None):
         self.processor = processor
         self.db = db
+        # Set from the flush thread to make the scanner pick up files it failed to queue
+        self._scan_event = scan_event
+        self._loop = asyncio.get_running_loop() if scan_event else None
+        self._get_file_type = processor.config.get_file_type
+        self._pending = queue.Queue()
+        self._stop_event = threading.Event()
+        self._flush_thread = threading.Thread(target=self._flush_loop, name='queue-flush', daemon=True)
+        
+    def start(self):
+        """Start the background flush thread"""
+        self._flush_thread.start()
+        
+    def stop(self):
+        """Stop the flush thread after a final flush"""
+        self._stop_event.set()
+        self._flush_thread.join()
         
     def on_created(self, event):
         """Handle new file creation"""
         if event.is_directory:
             return
             
-        file_path = Path(event.src_path)
-        ext = file_path.suffix.lower()
+        src_path = event.src_path
         
         # Check if it's a supported file type
-        if (ext in self.processor.config.media['image']['extensions'] or 
-            ext in self.processor.config.media['video']['extensions']):
+        file_type = self._get_file_type(os.path.splitext(src_path)[1].lower())
+        if file_type is not None:
+            self._pending.put((src_path, file_type))
             
+    def _flush_loop(self):
+        """Flush buffered files to the queue until stopped"""
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+        
+    def flush(self):
+        """Add all buffered files to the processing queue in one batch"""
+        rows = []
+        while True:
             try:
-                # Add to processing queue
-                file_type = 'image' if ext in self.processor.config.media['image']['extensions'] else 'video'
-                self.db.add_to_processing_queue(str(file_path), file_type)
-                logger.info(f"Added new file to processing queue: {file_path}")
-            except Exception as e:
-                logger.error(f"Error adding file to queue in file watcher: {e}")
-                # File will be picked up by periodic scanner if this fails
+                rows.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        if not rows:
+            return
+        rows = list(dict.fromkeys(rows))
+        
+        try:
+            added = self.db.add_to_processing_queue_batch(rows)
+            logger.info(f"Added {added} new files to processing queue")
+        except Exception as e:
+            logger.error(f"Error adding {len(rows)} files to queue in file watcher: {e}")
+            # Files will be picked up by the scanner, triggered right away
+            if self._scan_event is not None:
+                self._loop.call_soon_threadsafe(self._scan_event.set)
 
 
-async def scan_for_new_files(config: Config, db: DatabaseManager):
+async def scan_for_new_files(config: Config, db: DatabaseManager, scan_event: asyncio.Event = None):
     """Periodically scan for new files that might have been missed"""
-    last_scan_time = time.time()
     scan_interval = 60  # Scan every 60 seconds
+    scan_event = scan_event or asyncio.Event()
+    get_file_type = config.get_file_type
+    # Only files whose inode changed since the last successful scan are
+    # considered; ctime also moves when a file is renamed into imports
+    scan_watermark = 0.0
+    # Overlap between scans so files created during a scan are seen again even
+    # where ctime is truncated (1-2 s on SMB/FAT mounts); already queued files
+    # are filtered out below
+    watermark_margin = 5
     consecutive_errors = 0
     max_consecutive_errors = 5
     
     while True:
         try:
-            current_time = time.time()
-            if current_time - last_scan_time >= scan_interval:
-                logger.info("Running periodic scan for new files...")
-                imports_path = config.storage['imports']
-                new_files_found = 0
-                
-                for file_path in imports_path.iterdir():
-                    if file_path.is_file():
-                        ext = file_path.suffix.lower()
-                        if (ext in config.media['image']['extensions'] or 
-                            ext in config.media['video']['extensions']):
-                            
-                            try:
-                                # Check if file is already in queue
-                                existing = db.fetch_one(
-                                    "SELECT id FROM processing_queue WHERE file_path = %s",
-                                    (str(file_path),)
-                                )
-                                
-                                if not existing:
-                                    file_type = 'image' if ext in config.media['image']['extensions'] else 'video'
-                                    db.add_to_processing_queue(str(file_path), file_type)
-                                    logger.info(f"Found new file during scan: {file_path}")
-                                    new_files_found += 1
-                            except Exception as db_error:
-                                logger.error(f"Database error while scanning {file_path}: {db_error}")
-                                continue
-                
-                if new_files_found > 0:
-                    logger.info(f"Periodic scan found {new_files_found} new files")
-                else:
-                    logger.debug("Periodic scan found no new files")
-                    
-                last_scan_time = current_time
-                consecutive_errors = 0  # Reset error count on successful scan
+            # Sleep until the interval passes or the file watcher asks for a rescan
+            try:
+                await asyncio.wait_for(scan_event.wait(), timeout=scan_interval)
+            except asyncio.TimeoutError:
+                pass
+            scan_event.clear()
+            
+            scan_started = time.time()
+            logger.info("Running periodic scan for new files...")
+            imports_path = config.storage['imports']
+            candidates = {}
+            
+            with os.scandir(imports_path) as entries:
+                for entry in entries:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    file_type = get_file_type(os.path.splitext(entry.name)[1].lower())
+                    if file_type is None:
+                        continue
+                    if entry.stat(follow_symlinks=False).st_ctime >= scan_watermark:
+                        candidates[entry.path] = file_type
+            
+            # One query to find what is already queued, one to add the rest
+            queued = db.get_queued_paths(list(candidates))
+            rows = [(path, file_type) for path, file_type in candidates.items() if path not in queued]
+            new_files_found = db.add_to_processing_queue_batch(rows)
+            for path, _ in rows:
+                logger.info(f"Found new file during scan: {path}")
+            
+            if new_files_found > 0:
+                logger.info(f"Periodic scan found {new_files_found} new files")
+            else:
+                logger.debug("Periodic scan found no new files")
                 
-            await asyncio.sleep(10)  # Check every 10 seconds if it's time to scan
+            scan_watermark = scan_started - watermark_margin
+            consecutive_errors = 0  # Reset error count on successful scan
             
         except Exception as e:
             consecutive_errors += 1
@@ -1035,83 +1943,89 @@ async def scan_for_new_files(config: Config, db: DatabaseManager):
                 await asyncio.sleep(30 * consecutive_errors)  # Exponential backoff
 
 
-async def process_queue_worker(processor: MediaProcessor, db: DatabaseManager):
+async def process_queue_worker(processor: MediaProcessor, db: AsyncDatabaseManager):
     """Background worker to process queued jobs"""
     consecutive_errors = 0
     max_consecutive_errors = 5
+    worker_concurrency = processor.config.processing['worker_concurrency']
+    running = set()
     
-    while True:
+    async def run_job(job: dict):
+        """Process one claimed job"""
+        file_path = Path(job['file_path'])
         try:
-            # Get pending jobs
-            pending_jobs = db.get_pending_jobs(limit=5)
-            
-            # Get failed jobs that can be retried
-            failed_jobs = db.get_failed_jobs_for_retry(limit=3)
-            
-            # Combine all jobs
-            all_jobs = pending_jobs + failed_jobs
+            # Check if file still exists
+            if not file_path.exists():
+                logger.warning(f"File not found, marking as failed: {file_path}")
+                await db.update_queue_status(str(file_path), 'failed', 'File not found')
+                if job['file_type'] == 'video':
+                    await processor.forget_video_info(file_path)
+                return
             
-            if all_jobs:
-                logger.info(f"Found {len(all_jobs)} jobs to process")
-                
-                # Process each job
-                for job in all_jobs:
-                    file_path = Path(job['file_path'])
-                    
-                    try:
-                        # Check if file still exists
-                        if not file_path.exists():
-                            logger.warning(f"File not found, marking as failed: {file_path}")
-                            db.update_queue_status(str(file_path), 'failed', 'File not found')
-                            continue
-                        
-                        # Mark as processing
-                        db.mark_job_as_processing(job['id'])
-                        
-                        # If this is a retry, increment the retry count
-                        if job['retry_count'] > 0:
-                            logger.info(f"Retrying job (attempt {job['retry_count'] + 1}): {file_path}")
-                        
-                        # Process the file
-                        await processor.process_file(file_path)
-                        
-                    except (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.DatabaseError) as db_error:
-                        logger.error(f"Database error processing job {job['id']}: {db_error}")
-                        # Don't mark job as failed - let it retry when DB is back
-                        break  # Exit job loop to retry connection
-                        
-                    except Exception as e:
-                        logger.error(f"Failed to process {file_path}: {e}")
-                        # The process_file method already updates the status to 'failed'
-                        
-                        try:
-                            # If we still have retries left, increment retry count
-                            if job['retry_count'] + 1 < job['max_retries']:
-                                db.increment_retry_count(job['id'])
-                                logger.info(f"Job will be retried later: {file_path}")
-                        except Exception as retry_error:
-                            logger.error(f"Error updating retry count: {retry_error}")
+            # Claiming already marked the job as processing and counted the retry
+            if job['retry_count'] > 0:
+                logger.info(f"Retrying job (attempt {job['retry_count'] + 1}): {file_path}")
             
-            # Reset error count on successful iteration
-            consecutive_errors = 0
-            # Wait before checking again
-            await asyncio.sleep(5)
+            # Process the file
+            await processor.process_file(file_path)
             
-        except (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.DatabaseError) as db_error:
-            consecutive_errors += 1
-            logger.error(f"Database error in queue worker (attempt {consecutive_errors}): {db_error}")
+        except DB_ERRORS as db_error:
+            logger.error(f"Database error processing job {job['id']}: {db_error}")
+            # Don't mark job as failed - let it retry when DB is back
             
-            if consecutive_errors >= max_consecutive_errors:
-                logger.error(f"Too many consecutive database errors ({consecutive_errors}), waiting longer")
-                await asyncio.sleep(60)  # Wait 1 minute
-                consecutive_errors = 0  # Reset counter
-            else:
-                await asyncio.sleep(10 * consecutive_errors)  # Exponential backoff
-                
         except Exception as e:
-            consecutive_errors += 1
-            logger.error(f"Error in queue worker (attempt {consecutive_errors}): {e}")
-            await asyncio.sleep(10 * min(consecutive_errors, 6))  # Wait longer on error
+            logger.error(f"Failed to process {file_path}: {e}")
+            # The process_file method already updates the status to 'failed';
+            # the next claim of a failed job counts the retry
+    
+    try:
+        while True:
+            try:
+                # Claim only as many jobs as there are free slots, so no job
+                # sits in 'processing' while it waits for a worker
+                free_slots = worker_concurrency - len(running)
+                jobs = []
+                if free_slots > 0:
+                    jobs = await db.claim_jobs(limit=free_slots)
+                    # Fill the remaining slots with failed jobs that can be retried
+                    if len(jobs) < free_slots:
+                        jobs += await db.claim_jobs(limit=free_slots - len(jobs), retry_failed=True)
+                        
+                if jobs:
+                    logger.info(f"Claimed {len(jobs)} jobs to process")
+                for job in jobs:
+                    task = asyncio.create_task(run_job(job))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+                
+                # Reset error count on successful iteration
+                consecutive_errors = 0
+                # Refill a slot as soon as its job finishes, and check for new
+                # jobs every 5 seconds
+                if running:
+                    await asyncio.wait(running, timeout=5, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.sleep(5)
+                
+            except DB_ERRORS as db_error:
+                consecutive_errors += 1
+                logger.error(f"Database error in queue worker (attempt {consecutive_errors}): {db_error}")
+                
+                if consecutive_errors >= max_consecutive_errors:
+                    logger.error(f"Too many consecutive database errors ({consecutive_errors}), waiting longer")
+                    await asyncio.sleep(60)  # Wait 1 minute
+                    consecutive_errors = 0  # Reset counter
+                else:
+                    await asyncio.sleep(10 * consecutive_errors)  # Exponential backoff
+                    
+            except Exception as e:
+                consecutive_errors += 1
+                logger.error(f"Error in queue worker (attempt {consecutive_errors}): {e}")
+                await asyncio.sleep(10 * min(consecutive_errors, 6))  # Wait longer on error
+    finally:
+        # Interrupted jobs stay 'processing' and are requeued on the next start
+        for task in list(running):
+            task.cancel()
 
 
 async def database_health_monitor(db: DatabaseManager):
@@ -1139,74 +2053,97 @@ async def database_health_monitor(db: DatabaseManager):
 async def main():
     """Main function"""
     config = Config()
-    db = DatabaseManager(config.db_config)
+    db = DatabaseManager(config.db_config, config.processing['db_pool_size'])
+    async_db = AsyncDatabaseManager(config.db_config, db, config.processing['db_pool_size'])
+    processor = None
     
     try:
         # Connect to database
         db.connect()
+        await async_db.connect()
         
         # Log initial connection status
         stats = db.get_connection_stats()
         logger.info(f"Database connected successfully: {stats}")
         
+        # Bring databases created from an older schema.sql up to date
+        db.apply_migrations()
+        
         # Initialize processor (this will ensure encryption key exists)
-        processor = MediaProcessor(config, db)
+        processor = MediaProcessor(config, db, async_db)
         
         # Set up file watcher
-        event_handler = FileWatcher(processor, db)
+        scan_event = asyncio.Event()
+        event_handler = FileWatcher(processor, db, scan_event)
         observer = Observer()
         observer.schedule(event_handler, str(config.storage['imports']), recursive=True)
         
         # Start watching
+        event_handler.start()
         observer.start()
         logger.info(f"Watching directory: {config.storage['imports']}")
         
+        # Jobs still marked processing were interrupted by the last shutdown;
+        # this assumes a single processor instance per database
+        requeued = db.requeue_interrupted_jobs()
+        if requeued:
+            logger.info(f"Requeued {requeued} jobs interrupted by the last shutdown")
+        
         # Start queue worker
-        queue_worker_task = asyncio.create_task(process_queue_worker(processor, db))
+        queue_worker_task = asyncio.create_task(process_queue_worker(processor, async_db))
         logger.info("Started queue processing worker")
         
         # Start periodic file scanner
-        scanner_task = asyncio.create_task(scan_for_new_files(config, db))
+        scanner_task = asyncio.create_task(scan_for_new_files(config, db, scan_event))
         logger.info("Started periodic file scanner (scans every 60 seconds)")
         
         # Start database health monitor
         health_monitor_task = asyncio.create_task(database_health_monitor(db))
         logger.info("Started database health monitor (checks every 5 minutes)")
         
+        # Start hourly encryption key refresh
+        key_refresh_task = asyncio.create_task(processor._refresh_key_every(3600))
+        
         # Process any existing files in imports directory on startup
         imports_path = config.storage['imports']
+        get_file_type = config.get_file_type
+        startup_rows = []
+        with os.scandir(imports_path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    file_type = get_file_type(os.path.splitext(entry.name)[1].lower())
+                    if file_type is not None:
+                        startup_rows.append((entry.path, file_type))
+        
         startup_files_added = 0
-        for file_path in imports_path.iterdir():
-            if file_path.is_file():
-                ext = file_path.suffix.lower()
-                if (ext in config.media['image']['extensions'] or 
-                    ext in config.media['video']['extensions']):
-                    try:
-                        file_type = 'image' if ext in config.media['image']['extensions'] else 'video'
-                        db.add_to_processing_queue(str(file_path), file_type)
-                        logger.info(f"Added existing file to queue: {file_path}")
-                        startup_files_added += 1
-                    except Exception as e:
-                        logger.error(f"Error adding existing file to queue: {file_path}, error: {e}")
+        try:
+            startup_files_added = await async_db.add_to_processing_queue_batch(startup_rows)
+        except Exception as e:
+            logger.error(f"Error adding existing files to queue: {e}")
         
         if startup_files_added > 0:
             logger.info(f"Added {startup_files_added} existing files to processing queue")
         else:
-            logger.info("No existing files found in imports directory")
+            logger.info("No new files found in imports directory")
         
         # Keep running
         try:
-            await asyncio.gather(queue_worker_task, scanner_task, health_monitor_task)
+            await asyncio.gather(queue_worker_task, scanner_task, health_monitor_task, key_refresh_task)
         except KeyboardInterrupt:
             logger.info("Shutting down gracefully...")
             observer.stop()
             queue_worker_task.cancel()
             scanner_task.cancel()
             health_monitor_task.cancel()
+            key_refresh_task.cancel()
             
         observer.join()
+        event_handler.stop()
         
     finally:
+        if processor:
+            processor.close()
+        await async_db.disconnect()
         db.disconnect()
 
 